@@ -1,5 +1,4 @@
 import pandas as pd
-from sklearn.metrics import r2_score
 import matplotlib.pyplot as plt
 
 flu = pd.read_csv('/home/thomas/mt/statistics/irrigated_acreage_flu_oct21.csv').dropna()
@@ -41,14 +40,10 @@ flu = flu.loc[unet.index]
 # 1, 1
 # 1, 2
 
-from sklearn import linear_model
+from utils.bootstrap import regression_stats, bootstrap_regression
+
 def get_correlations(a, b):
-    coeff_det = r2_score(a, b)
-    regr = linear_model.LinearRegression()
-    regr.fit(a, b)
-    pred = regr.predict(a)
-    slope, intercept = regr.coef_[0][0], regr.intercept_
-    return coeff_det, slope, intercept
+    return regression_stats(a.ravel(), b.ravel())
 
 import numpy as np
 slog = False
@@ -68,15 +63,9 @@ for i, year in enumerate(years):
     coeff_det, slope, intercept = get_correlations(flu_, unet_)
 
     if btstrp:
-        slope_ = np.zeros((n_bags))
-        r2 = np.zeros((n_bags))
-        int_ = np.zeros((n_bags))
-        for j in range(n_bags):
-            indices = np.random.choice(unet.shape[0], replace=True, size=int(unet_.shape[0]*sz))
-            coeff_det, slope, intercept = get_correlations(flu_[indices], unet_[indices])
-            slope_[j] = slope
-            r2[j] = coeff_det
-            int_[j] = intercept
+        samples, intervals = bootstrap_regression(flu_, unet_, n_bags=n_bags, sz=sz)
+        slope_, r2, int_ = samples['slope'], samples['r2'], samples['intercept']
+        print(year, 'slope 95% CI: {:.3f} - {:.3f}'.format(*intervals['slope']))
 
         slope = np.mean(slope_)
         coeff_det = np.mean(r2)
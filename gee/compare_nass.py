@@ -1,5 +1,4 @@
 import pandas as pd
-from sklearn.metrics import r2_score
 import matplotlib.pyplot as plt
 
 nass = pd.read_csv('/home/thomas/mt/statistics/nass_merged.csv').dropna()
@@ -34,15 +33,10 @@ nass.columns = [int(p.replace('VALUE_', '')) for p in nass.columns]
 # plt.legend()
 # plt.show()
 
-from sklearn import linear_model
+from utils.bootstrap import regression_stats, bootstrap_regression
 
 def get_correlations(a, b):
-    coeff_det = r2_score(a, b)
-    regr = linear_model.LinearRegression()
-    regr.fit(a, b)
-    pred = regr.predict(a)
-    slope, intercept = regr.coef_[0][0], regr.intercept_
-    return coeff_det, slope, intercept
+    return regression_stats(a.ravel(), b.ravel())
 
 nass = nass.loc[unet.index]
 slog = False
@@ -65,15 +59,9 @@ for i, year in enumerate(years):
     coeff_det, slope, intercept = get_correlations(nass_, unet_)
 
     if btstrp:
-        slope_ = np.zeros((n_bags))
-        r2 = np.zeros((n_bags))
-        int_ = np.zeros((n_bags))
-        for j in range(n_bags):
-            indices = np.random.choice(unet.shape[0], replace=True, size=int(unet_.shape[0]*sz))
-            coeff_det, slope, intercept = get_correlations(nass_[indices], unet_[indices])
-            slope_[j] = slope
-            r2[j] = coeff_det
-            int_[j] = intercept
+        samples, intervals = bootstrap_regression(nass_, unet_, n_bags=n_bags, sz=sz)
+        slope_, r2, int_ = samples['slope'], samples['r2'], samples['intercept']
+        print(year, 'slope 95% CI: {:.3f} - {:.3f}'.format(*intervals['slope']))
 
         slope = np.mean(slope_)
         slope_std = np.std(slope_)
@@ -3,15 +3,9 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 from argparse import ArgumentParser
 
-import utils.utils as utils
-
-
-def numpyfy(dct):
+import numpy as np
 
-    out = {}
-    for k, v in dct.items():
-        out[k] = v.numpy()
-    return out
+import utils.utils as utils
 
 
 if __name__ == '__main__':
@@ -19,13 +13,17 @@ if __name__ == '__main__':
     ap = ArgumentParser()
 
     ap.add_argument('--data-directory', required=True)
-    ap.add_argument('--model-directory', required=True)
+    # several models (e.g. the checkpoints of a run) are all evaluated
+    # on every batch, so the data is only read once.
+    ap.add_argument('--model-directory', required=True, nargs='+')
     ap.add_argument('--batch-size', type=int, default=16)
     ap.add_argument('--n-classes', type=int, default=3)
     ap.add_argument('--use-cuda', action='store_true')
     ap.add_argument('--show-logs', action='store_true')
-    ap.add_argument('--year', default=None, type=str)
+    # 2003, 2008, 2009, 2010, 2011, 2012, 2013, 2015
+    ap.add_argument('--year', '--years', dest='years', default=None, type=str, nargs='+')
     ap.add_argument('--add-ndvi', action='store_true')
+    ap.add_argument('--parse-batch-size', type=int, default=32)
 
     args = ap.parse_args()
 
@@ -37,35 +35,41 @@ if __name__ == '__main__':
 
     import tensorflow as tf
 
-    model_path = args.model_directory
-    model = args.data_directory
-
-    loaded = tf.saved_model.load(model_path)
-    model = loaded.signatures['serving_default']
-
-    dataset = utils.make_validation_dataset(args.data_directory,
-                                            add_ndvi=args.add_ndvi, 
-                                            batch_size=args.batch_size,
-                                            year=args.year, 
-                                            n_classes=args.n_classes,
-                                            buffer_size=1,
-                                            temporal_unet=False,
-                                            border_labels=False)
-
-    # 2003, 2008, 2009, 2010, 2011, 2012, 2013, 2015
-    if not isinstance(dataset, list):
-        dataset = [dataset]
-
-    c, p, r, i = utils.confusion_matrix_from_generator(dataset, 
-                                                       batch_size=args.batch_size,
-                                                       model=model,
-                                                       n_classes=args.n_classes)
-
-    print('model path:', model_path)
-    print(c.numpy())
-    print('------------')
-    print(numpyfy(p))
-    print('------------')
-    print(numpyfy(r))
-    print('------------')
-    print(i)
+    models = []
+    for model_path in args.model_directory:
+        loaded = tf.saved_model.load(model_path)
+        models.append(loaded.signatures['serving_default'])
+
+    dataset = utils.make_grouped_validation_dataset(args.data_directory,
+                                                    add_ndvi=args.add_ndvi,
+                                                    batch_size=args.batch_size,
+                                                    years=args.years,
+                                                    n_classes=args.n_classes,
+                                                    temporal_unet=False,
+                                                    border_labels=False,
+                                                    parse_batch_size=args.parse_batch_size,
+                                                    deterministic=False)
+
+    cmats = utils.streaming_confusion_matrices(dataset,
+                                               models=models,
+                                               n_classes=args.n_classes,
+                                               n_groups=1 if args.years is None else len(args.years))
+
+    groups = ['all'] if args.years is None else args.years
+    for m, model_path in enumerate(args.model_directory):
+        print('model path:', model_path)
+        for g, group in enumerate(groups):
+            precision, recall = utils.precision_and_recall(cmats[g, m])
+            print('year:', group, 'pixels:', cmats[g, m].sum())
+            print(cmats[g, m])
+            print('precision:', np.round(precision, 4))
+            print('recall:   ', np.round(recall, 4))
+            print('------------')
+        if len(groups) > 1:
+            total = cmats[:, m].sum(axis=0)
+            precision, recall = utils.precision_and_recall(total)
+            print('all years, pixels:', total.sum())
+            print(total)
+            print('precision:', np.round(precision, 4))
+            print('recall:   ', np.round(recall, 4))
+            print('------------')
@@ -11,10 +11,9 @@ from tensorflow.keras.models import load_model
 from argparse import ArgumentParser
 
 import utils.feature_spec as feature_spec
+import utils.spectral_indices as spectral_indices
 from models.unet import unet
 
-NDVI_INDICES = [(2, 3), (8, 9), (14, 15), (20, 21), (26, 27), (32, 33)]
-
 
 def iterate_over_image_and_evaluate_patchwise(image_stack, model, out_filename, out_meta,
         n_classes, tile_size, chunk_size, dropout, h5_model):
@@ -76,19 +75,10 @@ def prepare_raster(f, ndvi):
     image_stack = image_stack[np.asarray(final_indices)] * 0.0001
     image_stack[np.isnan(image_stack)] = 0
     if ndvi:
-        out = []
-        for nir_idx, red_idx in NDVI_INDICES:
-            # Add a small constant in the denominator to ensure
-            # NaNs don't occur because of missing data. Missing
-            # data (i.e. Landsat 7 scan line failure) is represented as 0
-            # in TFRecord files. Adding \{epsilon} will barely 
-            # change the non-missing data, and will make sure missing data
-            # is still 0 when it's fed into the model.
-            ndvi = (image_stack[nir_idx] - image_stack[red_idx]) /\
-                    (image_stack[nir_idx] + image_stack[red_idx] + 1e-6) 
-            out.append(ndvi)
-        # print(image_stack.shape, np.stack(out).shape)
-        image_stack = np.concatenate((image_stack, np.stack(out)), axis=0)
+        # same indices, in the same order, as utils.to_tuple adds in training.
+        indices = spectral_indices.numpy_indices(image_stack,
+                spectral_indices.index_names(ndvi), axis=0)
+        image_stack = np.concatenate((image_stack, indices), axis=0)
 
     return image_stack, target_meta
 
@@ -199,6 +189,8 @@ if __name__ == '__main__':
     ap.add_argument('--chunk-size', type=int, default=256)
     ap.add_argument('--show-logs', action='store_true')
     ap.add_argument('--ndvi', action='store_true')
+    # e.g. --indices ndvi evi, in the order the model was trained with.
+    ap.add_argument('--indices', nargs='+', default=None)
     ap.add_argument('--dropout', action='store_true')
 
     args = ap.parse_args()
@@ -212,5 +204,5 @@ if __name__ == '__main__':
                       args.tile_size,
                       args.chunk_size,
                       args.show_logs,
-                      args.ndvi,
+                      args.indices or args.ndvi,
                       args.dropout)
@@ -3,16 +3,18 @@ import ee
 ee.Initialize()
 import time
 import os
+import zlib
+import hashlib
 import numpy as np
 from random import shuffle
 
 import utils.ee_utils as ee_utils
-from utils.shapefile_spec import shape_to_year_and_count as SHP_TO_YEAR_AND_COUNT
+from utils.task_scheduler import TaskScheduler
 
 class GEEExtractor:
 
     def __init__(self, year, out_gs_bucket, out_folder, mask_shapefiles, kernel_size=256,
-            n_shards=10):
+            n_shards=10, max_running_tasks=10, queue_file=None):
 
         self.year = year
         self.iter = 0
@@ -21,6 +23,12 @@ class GEEExtractor:
         self.n_shards = n_shards
         self.mask_shapefiles = mask_shapefiles
         self.kernel_size = kernel_size
+        # export tasks are queued and started at most max_running_tasks at a time.
+        # With a queue_file, a rerun after an interruption skips finished tasks.
+        self.scheduler = TaskScheduler(max_running=max_running_tasks,
+                queue_file=queue_file,
+                start_exceptions=(ee.ee_exception.EEException,),
+                get_status=lambda task_id: ee.data.getTaskStatus(task_id)[0])
 
         self._construct_data_stack()
 
@@ -52,73 +60,79 @@ class GEEExtractor:
 
 
     def extract_data_over_patches(self, patch_shapefiles, target_patch_name=None,
-            buffer_region=None, geotiff=False):
+            buffer_region=None, geotiff=False, wait=True):
         '''
         Extracts TFRecords over a ROI. ROIs are features in patch_shapefile.
+        If wait is False the export tasks are only queued, and run by a
+        later call to run_tasks.
         '''
         if isinstance(patch_shapefiles, list):
             for patch_shapefile in patch_shapefiles:
-                patch_shapefile = ee.FeatureCollection(patch_shapefile)
-                patches = patch_shapefile.toList(patch_shapefile.size())
-                out_filename = self._create_filename(patch_shapefiles)
-                for idx in range(patches.size().getInfo()):
-                    patch = ee.Feature(patches.get(idx))
-                    if buffer_region is not None:
-                        patch = patch.buffer(buffer_region)
-                    self._create_and_start_image_task(patch, out_filename, idx)
+                self._queue_patch_tasks(patch_shapefile, target_patch_name, buffer_region,
+                        bounds=False, geotiff=geotiff)
         else:
-            patches = ee.FeatureCollection(patch_shapefiles)
-            patches = patches.toList(patches.size())
-            out_filename = self._create_filename(patch_shapefiles)
-            for idx in range(patches.size().getInfo()):
-                patch = ee.Feature(patches.get(idx))
-                if buffer_region is not None:
-                    patch = patch.buffer(buffer_region)
+            self._queue_patch_tasks(patch_shapefiles, target_patch_name, buffer_region,
+                    bounds=True, geotiff=geotiff)
+        if wait:
+            self.run_tasks()
+
+
+    def _queue_patch_tasks(self, patch_shapefile, target_patch_name, buffer_region, bounds,
+            geotiff):
+        patches = ee.FeatureCollection(patch_shapefile)
+        if target_patch_name is not None:
+            patches = patches.filter(ee.Filter.inList('NAME', list(target_patch_name)))
+        # one paginated fetch of the feature ids; each export then selects its
+        # patch server-side instead of round-tripping per feature.
+        patch_ids = ee_utils.feature_ids(patches)
+        out_filename = self._create_filename(patch_shapefile)
+        for patch_id in patch_ids:
+            patch = ee.Feature(ee_utils.filter_by_ids(patches, [patch_id]).first())
+            if buffer_region is not None:
+                patch = patch.buffer(buffer_region)
+                if bounds:
                     patch = ee.Feature(patch.bounds())
-                self._create_and_start_image_task(patch, out_filename,
-                        idx=idx,
-                        target_patch_name=target_patch_name,
-                        geotiff=geotiff)
+            self._create_and_start_image_task(patch, out_filename, patch_id,
+                    geotiff=geotiff)
 
 
     def extract_data_over_shapefile(self, shapefile, percent=None, num=None,
-            shuffle=True):
+            shuffle=True, wait=True, seed=None):
         '''
         This method samples the data stack over the features in 
         the shapefile that is passed in. Sampling consists
         of choosing a random kernel_sizexkernel_size tile from
         the interior of a feature in the shapefile that is passed in.
         Percent governs the number of features chosen to extract over.
+        With shuffle, features are drawn with seed, which defaults to one
+        derived from the output filename, so a resumed run (see queue_file)
+        rebuilds the same shards. Pass a seed to draw a different sample.
         '''
         try:
             feature_collection = self.shapefile_to_feature_collection[shapefile]
         except KeyError as e:
             feature_collection = ee.FeatureCollection(shapefile)
-        feature_collection = feature_collection.toList(feature_collection.size())
-        try:
-            n_features = SHP_TO_YEAR_AND_COUNT[os.path.basename(shapefile)][self.year]
-        except:
-            n_features = 5238
+        ids = ee_utils.feature_ids(feature_collection)
+        n_features = len(ids)
 
         out_filename = self._create_filename(shapefile)
 
         if percent is not None:
             n = int(n_features * percent / 100)
-            if shuffle:
-                indices = [int(i) for i in np.random.choice(n_features, size=n, replace=False)]
-            else:
-                indices = [int(i) for i in range(n)]
         elif num is not None:
             n = int(num)
             assert( n <= n_features )
-            if shuffle:
-                indices = [int(i) for i in np.random.choice(n_features, size=n, replace=False)]
-            else:
-                indices = [int(i) for i in range(n)] # GEE wants ints.
         else:
             print("Either percent or num features to extract needs to be specified")
             exit(1)
 
+        if shuffle:
+            if seed is None:
+                seed = zlib.crc32(out_filename.encode('utf-8'))
+            indices = np.random.RandomState(seed).choice(n_features, size=n, replace=False)
+        else:
+            indices = np.arange(n)
+
         if len(indices):
             print('extracting data for {}, with {}/{} features chosen'.format(out_filename, n,
                 n_features))
@@ -126,32 +140,38 @@ class GEEExtractor:
             print('No features for {}'.format(out_filename))
             return
 
-        geometry_sample = ee.ImageCollection([])
-        feature_count = 0
-        for idx in indices:
-            feat = ee.Feature(feature_collection.get(idx))
-            sample = self.data_stack.sample(
+        def _sample(feat):
+            return self.data_stack.sample(
                      region=feat.geometry(),
                      scale=30,
                      numPixels=1,
                      tileScale=2,
                      dropNulls=False
                      )
-            geometry_sample = geometry_sample.merge(sample)
-            if (feature_count+1) % self.n_shards == 0:
-                geometry_sample = self._create_and_start_table_task(geometry_sample,
-                        out_filename, idx)
-            feature_count += 1
-        # take care of leftovers
-        self._create_and_start_table_task(geometry_sample, out_filename, idx)
 
+        # n_shards features per export, sampled by one server-side map.
+        for start in range(0, len(indices), self.n_shards):
+            shard_ids = [ids[i] for i in indices[start:start + self.n_shards]]
+            features = ee_utils.filter_by_ids(feature_collection, shard_ids)
+            geometry_sample = features.map(_sample).flatten()
+            # shards are keyed by their features, so a resumed run never
+            # mistakes a different shard for one that was already exported.
+            shard_key = hashlib.md5(','.join(map(str, sorted(shard_ids))).encode('utf-8'))
+            self._create_and_start_table_task(geometry_sample, out_filename,
+                    shard_key.hexdigest()[:12])
+        if wait:
+            self.run_tasks()
+
+
+    def run_tasks(self):
+        '''
+        Runs the queued export tasks to completion. Returns the names of
+        tasks that failed after all retries.
+        '''
+        return self.scheduler.run()
 
-    def _create_and_start_image_task(self, patch, out_filename, idx, target_patch_name,
-            geotiff=False):
 
-        if target_patch_name is not None:
-            if patch.get('NAME').getInfo() not in set(target_patch_name):
-                return
+    def _create_and_start_image_task(self, patch, out_filename, idx, geotiff=False):
 
         kwargs = {
                 'image':self.image_stack,
@@ -174,36 +194,21 @@ class GEEExtractor:
                                       'compressed':True,
                                       'maskedThreshold':0.99}
 
-        task = ee.batch.Export.image.toCloudStorage(
-                **kwargs
-                )
-        
-        self._start_task_and_handle_exception(task)
+        self.scheduler.add(out_filename + '_' + str(idx),
+                lambda: ee.batch.Export.image.toCloudStorage(**kwargs))
 
     
     def _create_and_start_table_task(self, geometry_sample, out_filename, idx):
-        task = ee.batch.Export.table.toCloudStorage(
-                collection=geometry_sample,
-                description=out_filename + str(time.time()),
-                bucket=self.out_gs_bucket,
-                fileNamePrefix=self.out_folder + str(idx) + out_filename + str(time.time()),
-                fileFormat='TFRecord',
-                selectors=self.features
-                )
-        geom = self._start_task_and_handle_exception(task)
-        return geom
-
-
-    def _start_task_and_handle_exception(self, task):
-
-        try:
-            task.start()
-        except ee.ee_exception.EEException as e:
-            print(e)
-            print('waiting to export, sleeping for 50 minutes')
-            time.sleep(3000)
-            task.start()
-        return ee.ImageCollection([])
+        kwargs = {
+                'collection':geometry_sample,
+                'description':out_filename + str(time.time()),
+                'bucket':self.out_gs_bucket,
+                'fileNamePrefix':self.out_folder + str(idx) + out_filename + str(time.time()),
+                'fileFormat':'TFRecord',
+                'selectors':self.features
+                }
+        self.scheduler.add(out_filename + '_' + str(idx),
+                lambda: ee.batch.Export.table.toCloudStorage(**kwargs))
 
     def _create_filename(self, shapefile):
 
@@ -11,6 +11,7 @@ import subprocess
 from types import SimpleNamespace
 
 import utils.utils as utils
+import utils.record_index as record_index
 import models.unet as unet
 import models.unet_attention as unet_attention
 import models.residual_unet as residual_unet
@@ -166,17 +167,32 @@ if __name__ == '__main__':
     if config.model_settings.print_model_summary:
         print(model.summary())
 
-    train = utils.make_balanced_training_dataset(os.path.join(config.data_settings.data_root,
-        config.data_settings.train_path), 
-        batch_size=config.model_settings.batch_size, 
-        add_ndvi=config.data_settings.add_ndvi,
-        sample_weights=config.data_settings.sample_weights_train,
-        year=config.data_settings.train_year,
-        buffer_size=config.data_settings.shuffle_buffer_size,
-        n_classes=config.model_settings.num_classes,
-        temporal_unet=config.model_settings.temporal_unet,
-        border_labels=config.model_settings.border_labels,
-        bootstrap=config.model_settings.bootstrap)
+    if config.data_settings.record_index is not None:
+        train = record_index.make_indexed_training_dataset(config.data_settings.record_index,
+            batch_size=config.model_settings.batch_size,
+            add_ndvi=config.data_settings.add_ndvi,
+            class_weights=config.data_settings.sample_weights_train,
+            year=config.data_settings.train_year,
+            n_classes=config.model_settings.num_classes,
+            temporal_unet=config.model_settings.temporal_unet,
+            border_labels=config.model_settings.border_labels,
+            bootstrap=config.model_settings.bootstrap,
+            deterministic=config.data_settings.deterministic)
+    else:
+        train = utils.make_balanced_training_dataset(os.path.join(config.data_settings.data_root,
+            config.data_settings.train_path), 
+            batch_size=config.model_settings.batch_size, 
+            add_ndvi=config.data_settings.add_ndvi,
+            sample_weights=config.data_settings.sample_weights_train,
+            year=config.data_settings.train_year,
+            buffer_size=config.data_settings.shuffle_buffer_size,
+            n_classes=config.model_settings.num_classes,
+            temporal_unet=config.model_settings.temporal_unet,
+            border_labels=config.model_settings.border_labels,
+            bootstrap=config.model_settings.bootstrap,
+            parse_batch_size=config.data_settings.parse_batch_size,
+            deterministic=config.data_settings.deterministic,
+            cache_directory=config.data_settings.cache_directory)
 
     validation = utils.make_validation_dataset(os.path.join(config.data_settings.data_root, 
         config.data_settings.test_path), 
@@ -186,7 +202,10 @@ if __name__ == '__main__':
         n_classes=config.model_settings.num_classes,
         buffer_size=config.data_settings.shuffle_buffer_size,
         temporal_unet=config.model_settings.temporal_unet,
-        border_labels=config.model_settings.border_labels)
+        border_labels=config.model_settings.border_labels,
+        parse_batch_size=config.data_settings.parse_batch_size,
+        deterministic=config.data_settings.deterministic,
+        cache_directory=config.data_settings.cache_directory)
 
     if os.path.isdir(config.data_settings.model_save_directory):
         model_save_directory = os.path.normpath(config.data_settings.model_save_directory) 
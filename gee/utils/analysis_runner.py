@@ -13,16 +13,9 @@ oss = os.path.splitext
 if __name__ == '__main__':
 
 
-    fname = '/home/thomas/mt/statistics/irrigated_acreage_flu_sept28.csv'
-    shapefiles = glob('/home/thomas/flu-data/*irrigated_area*.shp')
-    dct = defaultdict(dict)
-    for f in glob("/home/thomas/ssd/rasters_clipped_to_counties/*tif"):
-        ff = oss(osb(f))[0]
-        year = ff[-4:]
-        name = ff[:-5]
-        dct[name][year] = au.calc_irr_area(f)
-
-    df = pd.DataFrame.from_dict(dct)
-    df = df.sort_index()
-    df = df.sort_index(axis=1)
-    df.to_csv('/home/thomas/mt/statistics/irrigated_acreage_cnn_sept28.csv')
+    counties = '/home/thomas/irrigated-training-data-aug21/aux-shapefiles/MontanaCounties_shp/County.shp'
+    # one prediction raster per year; counties are rasterized once
+    # per grid instead of being clipped out with gdalwarp.
+    rasters = glob("/home/thomas/mt/montana-irr-rasters/rasters/*tif")
+    au.zonal_irrigated_statistics(rasters, counties,
+            csv_out='/home/thomas/mt/statistics/irrigated_acreage_cnn_sept28.csv')
@@ -2,6 +2,9 @@ import os
 import numpy as np
 import rasterio
 import rasterio.mask
+import rasterio.features
+import rasterio.windows
+import rasterio.transform
 import json
 import fiona
 import geopandas as gpd
@@ -12,23 +15,38 @@ import matplotlib.pyplot as plt
 import seaborn
 import seaborn as sns
 import pickle
+import hashlib
+import shapely
 
 import warnings; warnings.filterwarnings('ignore', 'GeoSeries.notna', UserWarning)
 
-from sklearn.metrics import confusion_matrix
 from shapely.geometry import box, Polygon
 from pyproj import CRS
-from rasterio import merge
 from copy import deepcopy
+from xml.etree import ElementTree as ET
 from glob import glob
 from subprocess import check_output
 from collections import defaultdict
+from multiprocessing import Pool
 
 import runspec as rs
 
 ACRES_PER_SQUARE_METER = 0.000247105
 MONTANA_SHAPEFILE = '/home/thomas/irrigated-training-data-aug21/aux-shapefiles/mt.shp'
 
+GDAL_DTYPES = {'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16',
+               'uint32': 'UInt32', 'int32': 'Int32', 'float32': 'Float32',
+               'float64': 'Float64'}
+
+# (shapefile, crs, transform, width, height) -> (zone id grid, zone names)
+_ZONE_CACHE = {}
+# class label rasters are uint8, with LABEL_NODATA where there's no label.
+LABEL_NODATA = 255
+# (shapefiles, year, crs, transform, height, width) -> label raster
+_LABEL_CACHE = {}
+# (shapefile, crs) -> reprojected GeoDataFrame
+_SHAPEFILE_CACHE = {}
+
 def crop_proportions_over_time(json_path):
     n = 6
     cdl_crop_values = {**rs.cdl_crop_values(), **rs.cdl_non_crop_values(), 
@@ -80,8 +98,27 @@ def merge_rasters_gdal(raster_files, out_filename):
         print(cmd)
 
 
+def _intersection_area_by_county(flu_geoms, county_geoms):
+    '''
+    Area of the intersection of every flu polygon with every county
+    it touches, summed by county index. Candidate pairs come from an
+    STRtree over the counties, so each flu polygon is only intersected
+    with the handful of counties whose envelopes it overlaps.
+    '''
+    tree = shapely.STRtree(county_geoms)
+    flu_idx, county_idx = tree.query(flu_geoms, predicate='intersects')
+    areas = shapely.area(shapely.intersection(flu_geoms[flu_idx], county_geoms[county_idx]))
+    return pd.Series(areas).groupby(county_idx).sum()
+
+
 def flu_data_irr_area_by_county(county_shp, flu, out_filename, plot=False,
-        save=False):
+        save=False, n_workers=1, chunk_size=10000):
+    '''
+    Sums the area (square meters, EPSG:5070) of irrigated FLU polygons in each
+    county and stores it in the IRR_AREA attribute. The overlay is done in one
+    vectorized pass; n_workers > 1 splits the flu polygons into chunks of
+    chunk_size and intersects them in a process pool.
+    '''
 
     if os.path.isfile(out_filename):
         return
@@ -94,53 +131,172 @@ def flu_data_irr_area_by_county(county_shp, flu, out_filename, plot=False,
     counties = counties.to_crs('EPSG:5070')
     counties_with_irr_attr = counties.copy()
 
-    irrigated_area = {}
-    for row in counties.iterrows():
-        polygon = Polygon(row[1]['geometry'])
-        county_name = row[1]['NAME']
-        try:
-            flu_county = gpd.clip(flu, polygon)
-        except Exception as e:
-            print('error', county_name, e)
-            irrigated_area[county_name] = -1
-            continue
-        if plot:
+    flu_geoms = shapely.make_valid(flu.geometry.to_numpy())
+    flu_geoms = flu_geoms[~shapely.is_empty(flu_geoms) & ~shapely.is_missing(flu_geoms)]
+    county_geoms = shapely.make_valid(counties.geometry.to_numpy())
+
+    if n_workers > 1:
+        chunks = [flu_geoms[i:i+chunk_size] for i in range(0, flu_geoms.shape[0], chunk_size)]
+        with Pool(processes=n_workers) as pool:
+            results = pool.starmap(_intersection_area_by_county,
+                    [(chunk, county_geoms) for chunk in chunks])
+        areas = pd.concat(results).groupby(level=0).sum()
+    else:
+        areas = _intersection_area_by_county(flu_geoms, county_geoms)
+
+    areas = areas.reindex(range(county_geoms.shape[0]), fill_value=0)
+
+    if plot:
+        for i, row in counties.reset_index(drop=True).iterrows():
+            flu_county = gpd.clip(flu, row['geometry'])
             fig, ax = plt.subplots()
             flu_county.plot(ax=ax)
-            poly_gdf = gpd.geopandas.GeoDataFrame([1], geometry=[polygon], crs=counties.crs)
-            poly_gdf.boundary.plot(ax=ax, color="red")
-            plt.title(county_name)
+            counties.iloc[[i]].boundary.plot(ax=ax, color="red")
+            plt.title(row['NAME'])
             plt.show()
-        else:
-            irr_acres = np.sum(flu_county['geometry'].area)
-            irrigated_area[county_name] = irr_acres
 
-    names = list(irrigated_area.keys())
-    areas = list(irrigated_area.values())
-    counties_with_irr_attr['IRR_AREA'] = areas
+    counties_with_irr_attr['IRR_AREA'] = areas.values
     if save:
         counties_with_irr_attr.to_file(out_filename)
+    return counties_with_irr_attr
 
 
-def merge_split_rasters_copy_band_descriptions(rasters, out_filename):
-
-    if not os.path.isfile(out_filename):
-        dsets = []
-        for raster in rasters:
-            dsets.append(rasterio.open(raster, 'r'))
-        merged, out_transform = merge.merge(dsets)
+def _mosaic_grid(rasters):
+    '''
+    Computes the union grid of rasters, which have to share a crs
+    and resolution (as split GEE exports do). Returns the profile of the
+    first raster updated to the union grid, its band descriptions, and the
+    (row, col) offset of every raster into that grid.
+    '''
+    with rasterio.open(rasters[0], 'r') as src:
+        profile = src.profile.copy()
+        descriptions = src.descriptions
+        xres, yres = src.res
+        crs = src.crs
 
-        with rasterio.open(rasters[0], 'r') as src:
-            meta = src.meta.copy()
-            descriptions = src.descriptions
-        meta.update({
-            'height': merged.shape[1],
-            'width': merged.shape[2],
-            'transform': out_transform
-            })
-        with rasterio.open(out_filename, 'w', **meta) as dst:
+    bounds = []
+    for raster in rasters:
+        with rasterio.open(raster, 'r') as src:
+            if src.crs != crs or not np.allclose(src.res, (xres, yres)):
+                raise ValueError('raster {} is not on the same grid as {}'.format(raster,
+                    rasters[0]))
+            bounds.append(src.bounds)
+
+    west = min(b.left for b in bounds)
+    north = max(b.top for b in bounds)
+    east = max(b.right for b in bounds)
+    south = min(b.bottom for b in bounds)
+    width = int(round((east - west) / xres))
+    height = int(round((north - south) / yres))
+    offsets = [(int(round((north - b.top) / yres)), int(round((b.left - west) / xres)))
+            for b in bounds]
+
+    profile.update({
+        'height': height,
+        'width': width,
+        'transform': rasterio.transform.from_origin(west, north, xres, yres)
+        })
+    return profile, descriptions, offsets
+
+
+def mosaic_rasters_windowed(rasters, out_filename, block_size=512):
+    '''
+    Mosaics rasters into a tiled GeoTIFF one output window at a time,
+    reading only the part of each raster that overlaps the window.
+    Memory use is bounded by the window size rather than the mosaic size.
+    Like rasterio.merge.merge, earlier rasters take precedence where they
+    overlap and have valid data.
+    '''
+    profile, descriptions, offsets = _mosaic_grid(rasters)
+    nodata = profile.get('nodata')
+    profile.update({'driver': 'GTiff', 'tiled': True, 'blockxsize': block_size,
+        'blockysize': block_size, 'compress': 'lzw', 'BIGTIFF': 'IF_SAFER'})
+
+    srcs = [rasterio.open(raster, 'r') for raster in rasters]
+    try:
+        with rasterio.open(out_filename, 'w', **profile) as dst:
             dst.descriptions = descriptions
-            dst.write(merged)
+            for _, window in dst.block_windows(1):
+                r0, c0 = window.row_off, window.col_off
+                r1, c1 = r0 + window.height, c0 + window.width
+                out = np.full((profile['count'], window.height, window.width),
+                        0 if nodata is None else nodata, dtype=profile['dtype'])
+                filled = np.zeros(out.shape, dtype=bool)
+                for src, (row, col) in zip(srcs, offsets):
+                    rr0, rr1 = max(r0, row), min(r1, row + src.height)
+                    cc0, cc1 = max(c0, col), min(c1, col + src.width)
+                    if rr0 >= rr1 or cc0 >= cc1:
+                        continue
+                    src_window = rasterio.windows.Window(cc0 - col, rr0 - row,
+                            cc1 - cc0, rr1 - rr0)
+                    arr = src.read(window=src_window)
+                    dst_slice = (slice(None), slice(rr0 - r0, rr1 - r0), slice(cc0 - c0, cc1 - c0))
+                    valid = ~filled[dst_slice]
+                    if nodata is not None:
+                        valid &= (arr != nodata)
+                    out[dst_slice][valid] = arr[valid]
+                    filled[dst_slice] |= valid
+                dst.write(out, window=window)
+    finally:
+        for src in srcs:
+            src.close()
+
+
+def build_vrt_mosaic(rasters, out_filename):
+    '''
+    Writes a VRT that mosaics rasters without materializing them. Sources
+    are listed in reverse so that, as with mosaic_rasters_windowed, the
+    first raster is painted last and takes precedence.
+    '''
+    profile, descriptions, offsets = _mosaic_grid(rasters)
+    nodata = profile.get('nodata')
+    root = ET.Element('VRTDataset', rasterXSize=str(profile['width']),
+            rasterYSize=str(profile['height']))
+    ET.SubElement(root, 'SRS').text = profile['crs'].to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = ', '.join(str(t) for t in
+            profile['transform'].to_gdal())
+
+    sizes = []
+    for raster in rasters:
+        with rasterio.open(raster, 'r') as src:
+            sizes.append((src.width, src.height))
+
+    for band in range(1, profile['count'] + 1):
+        vrt_band = ET.SubElement(root, 'VRTRasterBand',
+                dataType=GDAL_DTYPES[profile['dtype']], band=str(band))
+        if descriptions[band-1] is not None:
+            ET.SubElement(vrt_band, 'Description').text = descriptions[band-1]
+        if nodata is not None:
+            ET.SubElement(vrt_band, 'NoDataValue').text = str(nodata)
+        for raster, (row, col), (width, height) in reversed(list(zip(rasters,
+            offsets, sizes))):
+            source = ET.SubElement(vrt_band, 'ComplexSource')
+            ET.SubElement(source, 'SourceFilename',
+                    relativeToVRT='0').text = os.path.abspath(raster)
+            ET.SubElement(source, 'SourceBand').text = str(band)
+            ET.SubElement(source, 'SrcRect', xOff='0', yOff='0', xSize=str(width),
+                    ySize=str(height))
+            ET.SubElement(source, 'DstRect', xOff=str(col), yOff=str(row),
+                    xSize=str(width), ySize=str(height))
+            if nodata is not None:
+                ET.SubElement(source, 'NODATA').text = str(nodata)
+
+    ET.ElementTree(root).write(out_filename)
+
+
+def merge_split_rasters_copy_band_descriptions(rasters, out_filename, vrt=False,
+        block_size=512):
+    '''
+    Merges the split parts of a GEE export into one raster, keeping band
+    descriptions. The mosaic is written window by window; with vrt=True only
+    a VRT referencing the parts is written and the parts are kept.
+    '''
+
+    if not os.path.isfile(out_filename):
+        if vrt:
+            build_vrt_mosaic(rasters, out_filename)
+            return
+        mosaic_rasters_windowed(rasters, out_filename, block_size=block_size)
         for raster in rasters:
             print('removing', raster)
             os.remove(raster)
@@ -233,17 +389,96 @@ def tabulate_flu_data(shapefiles, out_filename):
     df.to_csv(out_filename)
 
 
+def irrigated_mask(arr):
+    '''
+    Boolean (h, w) mask of pixels where the irrigated class (band 0)
+    wins the argmax. Pixels that are 0 in every band are nodata.
+    '''
+    amax = np.argmax(arr, axis=0)
+    nodata = (np.sum(arr, axis=0) == 0)
+    return (amax == 0) & ~nodata
+
+
 def calc_irr_area(f):
     if not isinstance(f, np.ndarray):
         with rasterio.open(f, 'r') as src:
             arr = src.read()
     else:
         arr = f
-    amax = np.argmax(arr, axis=0)
-    mask = (np.sum(arr, axis=0) == 0)
-    amax = amax[~mask]
-    irrigated = amax[amax == 0]
-    return irrigated.shape[0]*(30**2)*ACRES_PER_SQUARE_METER
+    return np.count_nonzero(irrigated_mask(arr))*(30**2)*ACRES_PER_SQUARE_METER
+
+
+def county_zone_raster(county_shapefile, crs, transform, width, height,
+        name_field='NAME'):
+    '''
+    Rasterizes the polygons in county_shapefile onto the grid described by
+    (crs, transform, width, height). Zone ids start at 1, 0 is outside
+    every polygon. Returns the zone grid and a list of names where
+    names[i] is the name of zone i+1. Results are cached per grid, so
+    rasterizing only happens once for every set of rasters on the same grid.
+    '''
+    key = (os.path.abspath(county_shapefile), str(crs), tuple(transform),
+            width, height)
+    if key in _ZONE_CACHE:
+        return _ZONE_CACHE[key]
+
+    gdf = gpd.read_file(county_shapefile)
+    gdf = gdf[gdf.geometry.notnull()].to_crs(crs)
+    names = [n.lower().replace(" ", "_") for n in gdf[name_field]]
+    shapes = ((geom, i+1) for i, geom in enumerate(gdf.geometry))
+    dtype = np.uint16 if len(names) < np.iinfo(np.uint16).max else np.int32
+    zones = rasterio.features.rasterize(shapes, out_shape=(height, width),
+            transform=transform, fill=0, dtype=dtype)
+
+    _ZONE_CACHE[key] = (zones, names)
+    return zones, names
+
+
+def zonal_irrigated_pixel_counts(raster, county_shapefile, name_field='NAME'):
+    '''
+    Counts irrigated pixels (see irrigated_mask) in each county of
+    county_shapefile with one windowed pass over raster.
+    Returns an array of counts indexed by zone id (index 0 is outside
+    every county), the zone names, and the area of one pixel in square meters.
+    '''
+    with rasterio.open(raster, 'r') as src:
+        zones, names = county_zone_raster(county_shapefile, src.crs, src.transform,
+                src.width, src.height, name_field=name_field)
+        counts = np.zeros(len(names) + 1, dtype=np.int64)
+        for _, window in src.block_windows(1):
+            arr = src.read(window=window)
+            zone_window = zones[window.toslices()]
+            counts += np.bincount(zone_window[irrigated_mask(arr)],
+                    minlength=counts.shape[0])
+        pixel_area = abs(src.transform.a * src.transform.e)
+    return counts, names, pixel_area
+
+
+def zonal_irrigated_statistics(rasters, county_shapefile, csv_out=None, name_field='NAME'):
+    '''
+    Irrigated acreage by county and year, computed directly from
+    prediction rasters without clipping each county out to its own file.
+    The year is taken from the last four characters of each raster's
+    basename (i.e. irr2013.tif). Rasters that share a year are summed,
+    so a year can be split over non-overlapping tiles.
+    Returns a dataframe with years as the index and counties as columns.
+    '''
+    county_to_year_and_acres = defaultdict(dict)
+    for raster in rasters:
+        year = os.path.splitext(os.path.basename(raster))[0][-4:]
+        counts, names, pixel_area = zonal_irrigated_pixel_counts(raster,
+                county_shapefile, name_field=name_field)
+        acres = counts[1:]*pixel_area*ACRES_PER_SQUARE_METER
+        for name, area in zip(names, acres):
+            county_to_year_and_acres[name][year] = \
+                    county_to_year_and_acres[name].get(year, 0) + area
+
+    irr = pd.DataFrame.from_dict(county_to_year_and_acres)
+    irr = irr.sort_index() # sort by year
+    irr = irr.sort_index(axis=1) # and county name
+    if csv_out is not None:
+        irr.to_csv(csv_out)
+    return irr
 
 
 def convert_to_uint16(files):
@@ -400,6 +635,106 @@ def create_class_labels(shapefiles, assign_shapefile_class_code, mask_file, year
             class_labels[~out.mask] = class_code
     return class_labels
 
+def _is_temporal_shapefile(shapefile):
+    osb = os.path.basename(shapefile)
+    return ('irrigated' in osb and 'unirrigated' not in osb) or 'fallow' in osb
+
+
+def _reprojected_shapefile(shapefile, crs):
+    key = (os.path.abspath(shapefile), str(crs))
+    if key not in _SHAPEFILE_CACHE:
+        shp = gpd.read_file(shapefile)
+        shp = shp[shp.geometry.notnull()]
+        _SHAPEFILE_CACHE[key] = shp.to_crs(crs)
+    return _SHAPEFILE_CACHE[key]
+
+
+def class_label_raster(shapefiles, assign_shapefile_class_code, mask_file, year,
+        cache_dir=None):
+    '''
+    Same labels as create_class_labels, as a 2-D uint8 array on the grid of
+    mask_file with LABEL_NODATA where there is no label. Later shapefiles
+    overwrite earlier ones. Shapefiles are read and reprojected once per
+    crs, and the label raster is cached in memory (and in cache_dir as .npy,
+    if given) keyed by (shapefiles, year, target grid), so only the first
+    evaluation of a year builds it.
+    '''
+    with rasterio.open(mask_file, 'r') as src:
+        crs, transform = src.crs, src.transform
+        height, width = src.height, src.width
+        key = (tuple(os.path.abspath(f) for f in shapefiles), year, str(crs),
+                tuple(transform), height, width)
+        if key in _LABEL_CACHE:
+            return _LABEL_CACHE[key]
+
+        cache_file = None
+        if cache_dir is not None:
+            digest = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+            cache_file = os.path.join(cache_dir, 'labels_{}_{}.npy'.format(year, digest))
+            if os.path.isfile(cache_file):
+                _LABEL_CACHE[key] = np.load(cache_file)
+                return _LABEL_CACHE[key]
+
+        valid = src.dataset_mask() != 0
+
+    shapes = []
+    for f in shapefiles:
+        shp = _reprojected_shapefile(f, crs)
+        if _is_temporal_shapefile(f):
+            shp = shp.loc[shp['YEAR'] == year]
+        if shp.shape[0] == 0:
+            print('no features for {}, {}'.format(os.path.basename(f), year))
+            continue
+        class_code = assign_shapefile_class_code(f)
+        shapes.extend((geom, class_code) for geom in shp.geometry)
+
+    labels = np.full((height, width), LABEL_NODATA, dtype=np.uint8)
+    if len(shapes):
+        labels = rasterio.features.rasterize(shapes, out=labels, transform=transform)
+    labels[~valid] = LABEL_NODATA
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_file, labels)
+    _LABEL_CACHE[key] = labels
+    return labels
+
+
+def confusion_matrix_bincount(y_true, y_pred, n_classes):
+    '''
+    Confusion matrix with rows as true labels and columns as predictions,
+    like sklearn.metrics.confusion_matrix with labels=range(n_classes).
+    '''
+    idx = n_classes*y_true.astype(np.int64) + y_pred.astype(np.int64)
+    return np.bincount(idx, minlength=n_classes**2).reshape(n_classes, n_classes)
+
+
+def windowed_confusion_matrix(labels, prediction_raster, n_classes, to_classes):
+    '''
+    Accumulates the confusion matrix of labels (see class_label_raster)
+    against prediction_raster over its block windows. to_classes maps a
+    (bands, h, w) window of the prediction raster to an (h, w) array of
+    class predictions.
+    '''
+    cmat = np.zeros((n_classes, n_classes), dtype=np.int64)
+    with rasterio.open(prediction_raster, 'r') as src:
+        if (src.height, src.width) != labels.shape:
+            raise ValueError('{} is not on the grid of the labels'.format(prediction_raster))
+        for _, window in src.block_windows(1):
+            y_true = labels[window.toslices()]
+            labeled = y_true != LABEL_NODATA
+            if not np.any(labeled):
+                continue
+            y_pred = to_classes(src.read(window=window))
+            cmat += confusion_matrix_bincount(y_true[labeled], y_pred[labeled], n_classes)
+    return cmat
+
+
+def _raster_max(raster):
+    with rasterio.open(raster, 'r') as src:
+        return max(np.max(src.read(window=window)) for _, window in src.block_windows(1))
+
+
 def irrigated_label_mask(shapefiles):
     pass
 
@@ -427,11 +762,8 @@ def clip_to_mt_and_get_area(tif, save=False):
         print(out_image.shape)
 
     else:
-        amax = np.argmax(out_image, axis=0)
-        mask = (np.sum(out_image, axis=0) == 0)
-        amax = amax[~mask]
-        irrigated = amax[amax == 0]
-        return irrigated.shape[0]*(30**2)*ACRES_PER_SQUARE_METER
+        irrigated = irrigated_mask(out_image)
+        return np.count_nonzero(irrigated)*(30**2)*ACRES_PER_SQUARE_METER
 
 
 def filter_shapefile_by_year(shapefile, year):
@@ -480,7 +812,18 @@ def prf_from_cmat(cmat):
     rec = (tp)/(tp+fn)
     return oa, prec, rec, 2*prec*rec/(prec+rec)
 
-def cmats_from_preds():
+def cmats_from_preds(prediction_templates=None, mode='median_3', cache_dir=None):
+    '''
+    Confusion matrices of yearly prediction rasters against the test
+    shapefiles. prediction_templates is a list of paths with a {} for the
+    year, so several model variants can be evaluated while building the
+    labels for each year only once.
+    mode: 'median' thresholds a single band at half its max, 'median_3'
+    takes the argmax over classes, 'mean' takes the argmax and maps it to
+    irrigated (0) vs. not irrigated (1), matching the label codes of
+    assign_shapefile_class_code: rows 1 and 2 of the 'mean' matrices are
+    both not irrigated, and column 2 is empty.
+    '''
     years = [2003, 2008, 2009, 2010, 2011, 2012, 2013, 2015]
 
     shapefiles = [   'fallow_test.shp',
@@ -492,69 +835,44 @@ def cmats_from_preds():
     mask_raster = './irr_median2017.tif'
     root = '/home/thomas/irrigated-training-data-aug21/ee-dataset/data/test/'
     shapefiles = [root + s for s in shapefiles]
-    median = False
-    median_3 = True
-    ocmat = np.zeros((3,3))
+    r = '/home/thomas/mt/'
+    if prediction_templates is None:
+        prediction_templates = {
+                'median': [r + 'bootstrapped/irrmedian{}.tif'],
+                'median_3': ['/home/thomas/ssd/median_rasters/irrmedian3bands{}.tif'],
+                'mean': [r + 'bootstrapped/irrmean{}.tif']}[mode]
+    n_classes = 3
+    # argmax 0 is irrigated, like label code 0 in class_label_raster.
+    mean_to_binary = np.array([0, 1, 1])
+    ocmats = {t: np.zeros((n_classes, n_classes)) for t in prediction_templates}
     for year in years:
         print(year)
-        labels = create_class_labels(shapefiles,
-                                     assign_shapefile_class_code,
-                                     mask_raster,
-                                     year)
-        r = '/home/thomas/mt/'
-        if median:
-            median_raster,_ = load_raster(r + 'bootstrapped/irrmedian{}.tif'.format(year))
-            median_raster[median_raster >= np.max(median_raster)/2] = 1
-            median_raster[median_raster != 1] = 0
-            median_raster = median_raster[~labels.mask]
-            labels = labels[~labels.mask]
-            cmat = confusion_matrix(labels, median_raster)
-            cmat = confusion_matrix(labels, median_raster)
-            ocmat += cmat
-            print(prf_from_cmat(cmat))
-            print(cmat)
-            print('----')
-        elif median_3:
-            median_raster,_ = load_raster('/home/thomas/ssd/median_rasters/irrmedian3bands{}.tif'.format(year))
-            amax = np.argmax(median_raster, axis=0)
-            # amax[amax == 2] = 1 
-            # amax[amax == 0] = 2
-            # amax[amax == 1] = 0
-            # amax[amax == 2] = 1
-            labels = labels.squeeze()
-            nodata = np.sum(labels, axis=0) == 0
-            median_raster = amax[~labels.mask]
-            labels = labels[~labels.mask]
-            cmat = confusion_matrix(labels, median_raster)
-            ocmat += cmat
-            #print(prf_from_cmat(cmat))
-            print(cmat)
-            print('----')
-        else:
-            mean_raster,_ = load_raster(r + 'bootstrapped/irrmean{}.tif'.format(year))
-            amax = np.argmax(mean_raster, axis=0)
-            amax[amax == 2] = 1 
-            amax[amax == 0] = 2
-            amax[amax == 1] = 0
-            amax[amax == 2] = 1
-            mean_raster = amax[~labels.squeeze().mask]
-            labels = labels[~labels.mask].squeeze()
-            cmat = confusion_matrix(labels, mean_raster)
-            ocmat += cmat
-            print(prf_from_cmat(cmat))
+        labels = class_label_raster(shapefiles,
+                                    assign_shapefile_class_code,
+                                    mask_raster,
+                                    year,
+                                    cache_dir=cache_dir)
+        for template in prediction_templates:
+            prediction_raster = template.format(year)
+            if mode == 'median':
+                threshold = _raster_max(prediction_raster) / 2
+                to_classes = lambda arr: (arr[0] >= threshold).astype(np.uint8)
+            elif mode == 'median_3':
+                to_classes = lambda arr: np.argmax(arr, axis=0)
+            else:
+                to_classes = lambda arr: mean_to_binary[np.argmax(arr, axis=0)]
+            cmat = windowed_confusion_matrix(labels, prediction_raster, n_classes,
+                    to_classes)
+            ocmats[template] += cmat
+            print(template)
             print(cmat)
             print('----')
 
     print('final')
-    print(ocmat)
-    tn, fp, fn, tp = ocmat.ravel()
-    oa = (tn + tp) / (tn + fp + tp + fn)
-    prec = (tp)/(tp+fp)
-    rec = (tp)/(tp+fn)
-    print(oa, prec, rec, 2*prec*rec/(prec+rec))
-    print('----')
-
-
+    for template, ocmat in ocmats.items():
+        print(template)
+        print(ocmat)
+        print('----')
 
 
 if __name__ == '__main__':
@@ -37,6 +37,24 @@ def temporally_filter_features(shapefiles, year):
     return shapefile_to_feature_collection
 
 
+def feature_ids(feature_collection, page_size=5000):
+    '''
+    The system:index of every feature in feature_collection, fetched
+    page_size features per getInfo call (GEE returns at most 5000 features
+    per call). Only the ids are transferred, not the geometries.
+    '''
+    n_features = feature_collection.size().getInfo()
+    ids = []
+    for offset in range(0, n_features, page_size):
+        page = ee.FeatureCollection(feature_collection.toList(page_size, offset))
+        ids.extend(page.aggregate_array('system:index').getInfo())
+    return ids
+
+
+def filter_by_ids(feature_collection, ids):
+    return feature_collection.filter(ee.Filter.inList('system:index', list(ids)))
+
+
 def create_class_labels(shapefile_to_feature_collection):
     class_labels = ee.Image(0).byte()
     for shapefile, feature_collection in shapefile_to_feature_collection.items():
@@ -0,0 +1,237 @@
+import os
+import datetime
+import numpy as np
+import rasterio
+from glob import glob
+from collections import defaultdict
+from multiprocessing import Pool
+from rasterio.crs import CRS
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds, calculate_default_transform
+'''
+Local version of ee_utils.preprocess_data: six 32 day mean composites from
+May 1st of a year, over Landsat 5/7/8 surface reflectance scenes on disk,
+written with the band names and band order of feature_spec.features().
+
+Scenes are Collection 1 SR products unpacked to GeoTIFFs, i.e.
+<product id>_sr_band<n>.tif and <product id>_pixel_qa.tif, with
+product ids in the LXSS_LLLL_PPPRRR_YYYYMMDD_yyyymmdd_CC_TX format.
+'''
+
+from . import feature_spec
+
+# SR band numbers selected for each satellite, in the order of STD_NAMES.
+# Mirrors ee_utils.LC8_BANDS, LC7_BANDS and LC5_BANDS.
+SR_BANDS = {'08': [2, 3, 4, 5, 6, 7],
+            '07': [1, 2, 3, 4, 5, 7],
+            '05': [1, 2, 3, 4, 5, 7]}
+STD_NAMES = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']
+
+SR_FILL = -9999
+SR_SATURATED = 20000
+# pixel_qa bits: fill, cloud shadow and cloud, as in ee_utils.ls8mask
+QA_FILL = 1
+QA_MASK = 1 | 8 | 32
+
+N_COMPOSITES = 6
+COMPOSITE_DAYS = 32
+
+
+def parse_product_id(path):
+    '''
+    (satellite, date, path_row) of an SR file named with its product id,
+    LXSS_LLLL_PPPRRR_YYYYMMDD_yyyymmdd_CC_TX_...
+    '''
+    split = os.path.basename(path).split('_')
+    if len(split) < 7:
+        raise TypeError("expected filename in LXSS_LLLL_PPPRRR_YYYYMMDD_yyyymmdd_CC_TX format")
+    date = datetime.datetime.strptime(split[3], '%Y%m%d').date()
+    return split[0][2:4], date, split[2]
+
+
+def scene_catalog(scene_directory):
+    '''
+    Maps path/row to a date-sorted list of scenes found (recursively) in
+    scene_directory. Each scene is a dict with the satellite, the acquisition
+    date and the file prefix its bands are found at.
+    '''
+    catalog = defaultdict(list)
+    for qa in glob(os.path.join(scene_directory, '**', '*_pixel_qa.tif'), recursive=True):
+        satellite, date, path_row = parse_product_id(qa)
+        if satellite not in SR_BANDS:
+            continue
+        catalog[path_row].append({'satellite': satellite, 'date': date,
+            'prefix': qa[:-len('pixel_qa.tif')]})
+    for scenes in catalog.values():
+        scenes.sort(key=lambda s: s['date'])
+    return dict(catalog)
+
+
+def composite_bins(scenes, year):
+    '''
+    Splits scenes into the N_COMPOSITES periods of COMPOSITE_DAYS days
+    starting May 1st of year that temporalCollection reduces over.
+    Scenes outside of them are dropped.
+    '''
+    start = datetime.date(year, 5, 1)
+    bins = [[] for _ in range(N_COMPOSITES)]
+    for scene in scenes:
+        i = (scene['date'] - start).days // COMPOSITE_DAYS
+        if 0 <= i < N_COMPOSITES:
+            bins[i].append(scene)
+    return bins
+
+
+def composite_grid(scenes, crs=None, resolution=30):
+    '''
+    Output grid covering the union of scenes. Without crs the grid is in the
+    scenes' crs and aligned with the pixels of the first scene.
+    Returns (crs, transform, width, height).
+    '''
+    bounds = []
+    for scene in scenes:
+        with rasterio.open(scene['prefix'] + 'pixel_qa.tif') as src:
+            if not bounds:
+                src_crs, origin = src.crs, src.transform
+            bounds.append(transform_bounds(src.crs, src_crs, *src.bounds))
+    bounds = np.asarray(bounds)
+    left, bottom = bounds[:, 0].min(), bounds[:, 1].min()
+    right, top = bounds[:, 2].max(), bounds[:, 3].max()
+
+    if crs is not None and CRS.from_user_input(crs) != src_crs:
+        width = int(np.ceil((right - left) / origin.a))
+        height = int(np.ceil((top - bottom) / -origin.e))
+        transform, width, height = calculate_default_transform(src_crs, crs,
+                width, height, left, bottom, right, top, resolution=resolution)
+        return crs, transform, width, height
+
+    left = origin.c + np.floor((left - origin.c) / resolution) * resolution
+    top = origin.f + np.ceil((top - origin.f) / resolution) * resolution
+    width = int(np.ceil((right - left) / resolution))
+    height = int(np.ceil((top - bottom) / resolution))
+    return src_crs, from_origin(left, top, resolution, resolution), width, height
+
+
+def _open_warped(path, grid, nodata):
+    crs, transform, width, height = grid
+    src = rasterio.open(path)
+    if src.nodata is not None:
+        nodata = src.nodata
+    return WarpedVRT(src, crs=crs, transform=transform, width=width, height=height,
+            resampling=Resampling.nearest, src_nodata=nodata, nodata=nodata)
+
+
+def _composite_window(bin_datasets, window):
+    '''
+    Mean of the valid observations of each band over the scenes of a bin,
+    nan where there are none. bin_datasets is a list of (qa, bands) VRTs.
+    '''
+    shape = (len(STD_NAMES), int(window.height), int(window.width))
+    total = np.zeros(shape, dtype=np.float32)
+    count = np.zeros(shape, dtype=np.uint16)
+    for qa, bands in bin_datasets:
+        clear = (qa.read(1, window=window) & QA_MASK) == 0
+        for b, band in enumerate(bands):
+            data = band.read(1, window=window)
+            valid = clear & (data != band.nodata) & (data != SR_SATURATED)
+            total[b][valid] += data[valid]
+            count[b] += valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+    mean[count == 0] = np.nan
+    return mean
+
+
+def composite_path_row(scenes, year, out_filename, crs=None, resolution=30,
+        block_size=512):
+    '''
+    Writes the six 32 day composites of scenes (one path/row, see
+    scene_catalog) to out_filename as a float32 GeoTIFF, one band per
+    feature_spec feature (0_blue_mean, 0_green_mean, ...), nan as nodata.
+    Composites are computed and written block_size x block_size pixels at a
+    time, so memory use doesn't depend on the size of the output.
+    '''
+    bins = composite_bins(scenes, year)
+    in_season = [s for b in bins for s in b]
+    if not in_season:
+        print('no scenes for {} in {}'.format(out_filename, year))
+        return None
+    grid = composite_grid(in_season, crs, resolution)
+    crs, transform, width, height = grid
+
+    features = feature_spec.features()
+    band_index = [[features.index('{}_{}_mean'.format(i, name)) + 1 for name in STD_NAMES]
+            for i in range(N_COMPOSITES)]
+
+    datasets = []
+    for scenes_in_bin in bins:
+        datasets.append([(_open_warped(s['prefix'] + 'pixel_qa.tif', grid, QA_FILL),
+            [_open_warped('{}sr_band{}.tif'.format(s['prefix'], n), grid, SR_FILL)
+                for n in SR_BANDS[s['satellite']]]) for s in scenes_in_bin])
+
+    profile = {'driver': 'GTiff', 'dtype': 'float32', 'nodata': np.nan, 'count': len(features),
+            'crs': crs, 'transform': transform, 'width': width, 'height': height,
+            'tiled': True, 'blockxsize': block_size, 'blockysize': block_size,
+            'compress': 'deflate', 'BIGTIFF': 'IF_SAFER'}
+    try:
+        with rasterio.open(out_filename, 'w', **profile) as dst:
+            for i, feature in enumerate(features):
+                dst.set_band_description(i + 1, feature)
+            for _, window in dst.block_windows(1):
+                for i, bin_datasets in enumerate(datasets):
+                    if bin_datasets:
+                        mean = _composite_window(bin_datasets, window)
+                    else:
+                        mean = np.full((len(STD_NAMES), int(window.height), int(window.width)),
+                                np.nan, dtype=np.float32)
+                    dst.write(mean, indexes=band_index[i], window=window)
+    finally:
+        for bin_datasets in datasets:
+            for qa, bands in bin_datasets:
+                for vrt in [qa] + bands:
+                    src = vrt.src_dataset
+                    vrt.close()
+                    src.close()
+    return out_filename
+
+
+def _composite_path_row(args):
+    return composite_path_row(*args)
+
+
+def composite_scenes(scene_directory, year, out_directory, crs=None, resolution=30,
+        n_workers=None):
+    '''
+    Composites every path/row with scenes in scene_directory, in parallel
+    across path/rows. Writes out_directory/<path_row>_<year>.tif and
+    returns the written filenames.
+    '''
+    catalog = scene_catalog(scene_directory)
+    args = []
+    for path_row, scenes in sorted(catalog.items()):
+        out_filename = os.path.join(out_directory, '{}_{}.tif'.format(path_row, year))
+        args.append((scenes, year, out_filename, crs, resolution))
+    with Pool(n_workers) as pool:
+        out = pool.map(_composite_path_row, args)
+    return [f for f in out if f is not None]
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+
+    # utils is a package with relative imports, so this runs as a module:
+    ap = ArgumentParser(description='Composites Landsat SR scenes on disk. Run from gee/ as '
+            '`python -m utils.local_composite ...`.')
+    ap.add_argument('--scene-directory', required=True)
+    ap.add_argument('--out-directory', required=True)
+    ap.add_argument('--year', type=int, required=True)
+    ap.add_argument('--crs', default=None, help='e.g. EPSG:5070. Defaults to the scenes\' crs.')
+    ap.add_argument('--n-workers', type=int, default=None)
+    args = ap.parse_args()
+
+    os.makedirs(args.out_directory, exist_ok=True)
+    composite_scenes(args.scene_directory, args.year, args.out_directory, crs=args.crs,
+            n_workers=args.n_workers)
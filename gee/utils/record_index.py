@@ -0,0 +1,177 @@
+import os
+import gzip
+import numpy as np
+import tensorflow as tf
+'''
+Class-to-record index for balanced sampling of training data.
+
+build_record_index makes one pass over the GZIP TFRecords GEE exports,
+counts label pixels per class in every record, and writes each record to its
+own file so that it can be read by record id. make_indexed_training_dataset
+then draws a class by weight and a record containing that class, so no
+per-class shuffle buffers are needed.
+'''
+
+from . import feature_spec
+from . import utils
+
+INDEX_FILENAME = 'record_index.npz'
+RECORDS_PER_DIRECTORY = 1000
+
+
+def _record_path(out_directory, record_id):
+    return os.path.join(out_directory, '{:04d}'.format(record_id // RECORDS_PER_DIRECTORY),
+            '{:07d}.gz'.format(record_id))
+
+
+def _class_counts(n_classes):
+    labels_dict = {'constant': feature_spec.features_dict()['constant']}
+
+    def _counts(example_proto):
+        labels = tf.io.parse_single_example(example_proto, labels_dict)['constant']
+        # label rasters are 1-indexed, 0 is nodata.
+        counts = tf.math.bincount(tf.reshape(tf.cast(labels, tf.int32), [-1]),
+                minlength=n_classes+1, maxlength=n_classes+1, dtype=tf.int64)
+        return example_proto, counts[1:]
+
+    return _counts
+
+
+def build_record_index(files, out_directory, n_classes):
+    '''
+    Reads every record in files (GZIP TFRecords) once and writes
+      - each serialized record to its own GZIP file under out_directory,
+      - out_directory/record_index.npz with, for every record id, the record's
+        path, the file it came from and its label pixel count per class.
+    Run this on a training directory after its exports are downloaded.
+    '''
+    counts = []
+    paths = []
+    sources = []
+    record_id = 0
+    for f in sorted(files):
+        dataset = tf.data.TFRecordDataset(f, compression_type='GZIP')
+        dataset = dataset.map(_class_counts(n_classes),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        for example_proto, class_counts in dataset:
+            path = _record_path(out_directory, record_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with gzip.open(path, 'wb') as dst:
+                dst.write(example_proto.numpy())
+            paths.append(path)
+            sources.append(os.path.basename(f))
+            counts.append(class_counts.numpy())
+            record_id += 1
+        print('indexed {}, {} records so far'.format(f, record_id))
+
+    counts = np.asarray(counts, dtype=np.int64).reshape(-1, n_classes)
+    index_file = os.path.join(out_directory, INDEX_FILENAME)
+    np.savez(index_file, paths=np.asarray(paths), sources=np.asarray(sources), counts=counts)
+    return index_file
+
+
+def load_record_index(index_file):
+    with np.load(index_file) as index:
+        return index['paths'], index['sources'], index['counts']
+
+
+def _record_sampler(counts, class_weights):
+    '''
+    Builds a graph-mode function that draws a class by class_weights, then a
+    record containing that class with probability proportional to its pixel
+    count of the class. Each draw is a categorical over the classes and a
+    binary search over that class's cumulative pixel counts.
+    '''
+    n_classes = counts.shape[1]
+    class_weights = np.asarray(class_weights, dtype=np.float64)
+    if class_weights.sum() == 0:
+        class_weights = np.ones(n_classes)
+    has_records = counts.sum(axis=0) > 0
+    class_weights = np.where(has_records, class_weights, 0)
+    if class_weights.sum() == 0:
+        raise ValueError('no records contain a class with nonzero weight')
+
+    record_ids = []
+    cumulative_counts = []
+    for c in range(n_classes):
+        ids = np.nonzero(counts[:, c])[0]
+        record_ids.append(ids)
+        cumulative_counts.append(np.cumsum(counts[ids, c]))
+    record_ids = tf.ragged.constant(record_ids, dtype=tf.int64)
+    cumulative_counts = tf.ragged.constant(cumulative_counts, dtype=tf.int64)
+    logits = tf.math.log(tf.constant([class_weights / class_weights.sum()], dtype=tf.float32))
+
+    def _sample(_):
+        c = tf.random.categorical(logits, 1)[0, 0]
+        cdf = cumulative_counts[c]
+        u = tf.random.uniform((), maxval=cdf[-1], dtype=tf.int64)
+        i = tf.searchsorted(cdf, u[tf.newaxis], side='right')[0]
+        return record_ids[c][i]
+
+    return _sample
+
+
+def make_indexed_training_dataset(index_file,
+                                  add_ndvi,
+                                  batch_size,
+                                  class_weights,
+                                  year,
+                                  n_classes,
+                                  temporal_unet,
+                                  border_labels,
+                                  bootstrap,
+                                  deterministic=True):
+    '''
+    Drop-in replacement for utils.make_balanced_training_dataset that draws
+    batches from a record index built by build_record_index.
+    class_weights has one weight per label class (all zeros means equal
+    weights). year and bootstrap filter and resample the indexed records the
+    same way make_balanced_training_dataset filters and resamples files.
+    '''
+    paths, sources, counts = load_record_index(index_file)
+
+    if year is not None:
+        keep = np.asarray([year in s for s in sources])
+        print('Length of train records before removing year {}: {}'.format(year, len(paths)))
+        paths, counts = paths[keep], counts[keep]
+        print('Length of train records after removing year {}: {}'.format(year, len(paths)))
+
+    if bootstrap:
+        print('bootstrapping...')
+        indices = np.random.choice(len(paths), size=len(paths), replace=True)
+        paths, counts = paths[indices], counts[indices]
+
+    paths = tf.constant(paths)
+    sample_fn = _record_sampler(counts, class_weights)
+    if temporal_unet:
+        to_tuple_fn = utils.to_shared_tuple(add_ndvi, n_classes)
+    else:
+        to_tuple_fn = utils.to_tuple(add_ndvi, n_classes, border_labels)
+
+    def _read(record_id):
+        contents = tf.io.read_file(tf.gather(paths, record_id))
+        return utils.parse_tfrecord(tf.io.decode_compressed(contents, compression_type='GZIP'))
+
+    dataset = tf.data.Dataset.range(1).repeat()
+    dataset = dataset.map(sample_fn)
+    dataset = dataset.map(_read, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=deterministic)
+    dataset = dataset.map(to_tuple_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=deterministic)
+    return dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+
+    # utils is a package with relative imports, so this runs as a module:
+    ap = ArgumentParser(description='Builds a record index of GZIP TFRecords. Run from gee/ as '
+            '`python -m utils.record_index ...`.')
+    ap.add_argument('--data-directory', required=True)
+    ap.add_argument('--out-directory', required=True)
+    ap.add_argument('--n-classes', type=int, default=3)
+    args = ap.parse_args()
+
+    files = tf.io.gfile.glob(os.path.join(args.data_directory, '*gz'))
+    build_record_index(files, args.out_directory, args.n_classes)
@@ -0,0 +1,225 @@
+import os
+import numpy as np
+import rasterio
+import rasterio.features
+import pandas as pd
+import geopandas as gpd
+import tensorflow as tf
+from multiprocessing import Pool
+from rasterio.windows import Window
+from shapely.geometry import box
+'''
+Cuts training patches out of GeoTIFF exports (GEEExtractor with
+geotiff=True, or local_composite output) and rasterized label shapefiles,
+and writes them as GZIP TFRecords that parse with feature_spec.features_dict(),
+like the TFRecords GEE exports with patchDimensions 256 and maskedThreshold
+0.99. Patch size and stride are parameters, so training sets can be cut
+differently without new exports.
+
+Each patch goes to the shards of its most common label class, named like
+the class shapefiles GEE exports come from ('irrigated', 'unirrigated',
+'uncultivated'), so utils.filter_list_into_classes and the class-balanced
+loader pick them up. Patches without labels go to 'unlabeled' shards, which
+the balanced loader leaves out.
+'''
+
+from . import feature_spec
+from . import record_index
+
+
+def shapefile_class_code(shapefile):
+    '''
+    Same class codes as ee_utils.assign_class_code.
+    '''
+    name = os.path.basename(shapefile)
+    if 'irrigated' in name and 'unirrigated' not in name:
+        return 0
+    if 'unirrigated' in name or 'fallow' in name:
+        return 1
+    if 'wetlands' in name or 'uncultivated' in name:
+        return 2
+    raise NameError('shapefile path {} isn\'t named in shapefile_class_code'.format(shapefile))
+
+
+# shard names of class codes 0, 1 and 2, see utils.filter_list_into_classes
+CLASS_NAMES = ['irrigated', 'unirrigated', 'uncultivated']
+UNLABELED = 'unlabeled'
+
+
+def patch_class(labels):
+    '''
+    Name of the most common class in a label patch (values class code + 1,
+    0 for no label), UNLABELED if it has no labels.
+    '''
+    counts = np.bincount(labels.ravel(), minlength=len(CLASS_NAMES) + 1)[1:len(CLASS_NAMES) + 1]
+    if counts.sum() == 0:
+        return UNLABELED
+    return CLASS_NAMES[int(np.argmax(counts))]
+
+
+def _is_temporal(shapefile):
+    name = os.path.basename(shapefile)
+    return ('irrigated' in name and 'unirrigated' not in name) or 'fallow' in name
+
+
+def label_shapes(shapefiles, year, crs):
+    '''
+    Features of shapefiles in crs with a 'label' column of class code + 1,
+    i.e. the values create_class_labels paints. Irrigated and fallow features
+    are filtered to year. Later shapefiles paint over earlier ones.
+    '''
+    out = []
+    for f in shapefiles:
+        shp = gpd.read_file(f)
+        shp = shp[shp.geometry.notnull()]
+        if _is_temporal(f):
+            shp = shp.loc[shp['YEAR'] == year]
+        if shp.shape[0] == 0:
+            print('no features for {}, {}'.format(os.path.basename(f), year))
+            continue
+        shp = shp.to_crs(crs)[['geometry']]
+        shp['label'] = shapefile_class_code(f) + 1
+        out.append(shp)
+    if not out:
+        return gpd.GeoDataFrame({'label': []}, geometry=gpd.GeoSeries([], crs=crs))
+    return gpd.GeoDataFrame(pd.concat(out, ignore_index=True), crs=crs)
+
+
+def feature_bands(image_file):
+    '''
+    1-based band indexes of image_file holding each of the sorted
+    feature_spec features, found by band description.
+    '''
+    with rasterio.open(image_file) as src:
+        descriptions = list(src.descriptions)
+    features = sorted(feature_spec.features())
+    missing = [f for f in features if f not in descriptions]
+    if missing:
+        raise ValueError('{} has no bands named {}'.format(image_file, missing))
+    return [descriptions.index(f) + 1 for f in features]
+
+
+def patch_origins(height, width, patch_size, stride):
+    rows = range(0, height - patch_size + 1, stride)
+    cols = range(0, width - patch_size + 1, stride)
+    return [(r, c) for r in rows for c in cols]
+
+
+def _serialize(data, labels, features):
+    feature = {name: tf.train.Feature(float_list=tf.train.FloatList(value=band.ravel()))
+            for name, band in zip(features, data)}
+    feature['constant'] = tf.train.Feature(float_list=tf.train.FloatList(
+        value=labels.ravel().astype(np.float32)))
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+_SHAPES = None
+
+
+def _init_worker(shapes):
+    # labels are sent to each worker once, not with every task.
+    global _SHAPES
+    _SHAPES = shapes
+
+
+def _write_shard(args):
+    # writes the patches at origins to out_file.format(class name), one
+    # file per class present.
+    image_file, bands, origins, out_file, patch_size, masked_threshold = args
+    features = sorted(feature_spec.features())
+    options = tf.io.TFRecordOptions(compression_type='GZIP')
+    writers = {}
+    with rasterio.open(image_file) as src:
+        nodata = src.nodata
+        for row, col in origins:
+            window = Window(col, row, patch_size, patch_size)
+            data = src.read(bands, window=window).astype(np.float32)
+            missing = ~np.isfinite(data)
+            if nodata is not None:
+                missing |= data == nodata
+            masked = np.all(missing, axis=0)
+            if masked.mean() > masked_threshold:
+                continue
+            # GEE writes masked pixels as 0.
+            data[missing] = 0
+
+            transform = src.window_transform(window)
+            hits = _SHAPES.sindex.query(box(*rasterio.windows.bounds(window, src.transform)))
+            labels = np.zeros((patch_size, patch_size), dtype=np.uint8)
+            if len(hits):
+                shapes = _SHAPES.iloc[np.sort(hits)]
+                labels = rasterio.features.rasterize(zip(shapes.geometry, shapes['label']),
+                        out=labels, transform=transform)
+            # like the label band of GEE exports, labels aren't masked with the data.
+            class_name = patch_class(labels)
+            if class_name not in writers:
+                writers[class_name] = tf.io.TFRecordWriter(out_file.format(class_name), options)
+            writers[class_name].write(_serialize(data, labels, features))
+    for writer in writers.values():
+        writer.close()
+    return [out_file.format(c) for c in sorted(writers)]
+
+
+def retile(image_file, shapefiles, year, out_directory, prefix=None, patch_size=256,
+        stride=None, masked_threshold=0.99, patches_per_shard=64, n_workers=None):
+    '''
+    Writes patch_size x patch_size patches of image_file, taken every stride
+    pixels (patch_size by default, i.e. not overlapping), with labels
+    rasterized from shapefiles for year, to GZIP TFRecord shards in
+    out_directory. Patches with a larger fraction of masked pixels than
+    masked_threshold are dropped. Shards are written in parallel and named
+    <prefix>_<class>_<year>_<shard>.gz, prefix being the image filename by
+    default and class that of the patches (see patch_class).
+    Returns the shard filenames. Records only parse with features_dict() if
+    patch_size matches the shapes in feature_spec.
+    '''
+    if stride is None:
+        stride = patch_size
+    if prefix is None:
+        prefix = os.path.splitext(os.path.basename(image_file))[0]
+    bands = feature_bands(image_file)
+    with rasterio.open(image_file) as src:
+        crs, height, width = src.crs, src.height, src.width
+    shapes = label_shapes(shapefiles, year, crs)
+    origins = patch_origins(height, width, patch_size, stride)
+
+    os.makedirs(out_directory, exist_ok=True)
+    tasks = []
+    for i, start in enumerate(range(0, len(origins), patches_per_shard)):
+        out_file = os.path.join(out_directory, '{}_{{}}_{}_{:05d}.gz'.format(prefix, year, i))
+        tasks.append((image_file, bands, origins[start:start + patches_per_shard], out_file,
+            patch_size, masked_threshold))
+    with Pool(n_workers, initializer=_init_worker, initargs=(shapes,)) as pool:
+        shards = [f for written in pool.map(_write_shard, tasks) for f in written]
+    print('{}: {} shards from {} candidate patches'.format(image_file, len(shards), len(origins)))
+    return shards
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+
+    # utils is a package with relative imports, so this runs as a module:
+    ap = ArgumentParser(description='Cuts GeoTIFF exports into training TFRecords. Run from gee/ as '
+            '`python -m utils.retile ...`.')
+    ap.add_argument('--image-files', nargs='+', required=True)
+    ap.add_argument('--shapefiles', nargs='+', required=True)
+    ap.add_argument('--year', type=int, required=True)
+    ap.add_argument('--out-directory', required=True)
+    ap.add_argument('--patch-size', type=int, default=256)
+    ap.add_argument('--stride', type=int, default=None)
+    ap.add_argument('--masked-threshold', type=float, default=0.99)
+    ap.add_argument('--n-workers', type=int, default=None)
+    ap.add_argument('--record-index', action='store_true',
+            help='also build a record index of the shards, see record_index.py')
+    ap.add_argument('--n-classes', type=int, default=3)
+    args = ap.parse_args()
+
+    shards = []
+    for image_file in args.image_files:
+        shards.extend(retile(image_file, args.shapefiles, args.year, args.out_directory,
+            patch_size=args.patch_size, stride=args.stride,
+            masked_threshold=args.masked_threshold, n_workers=args.n_workers))
+    if args.record_index:
+        record_index.build_record_index(shards, os.path.join(args.out_directory, 'index'),
+                args.n_classes)
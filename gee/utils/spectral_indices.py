@@ -0,0 +1,114 @@
+import numpy as np
+import tensorflow as tf
+'''
+Spectral indices of the composites in a feature stack, for every timestep
+at once. Works on TF tensors (channels last) and NumPy arrays (any channel
+axis). The channel of each band at each timestep is looked up by the
+'{timestep}_{band}_mean' names in feature_spec, so nothing here depends on
+hardcoded channel numbers.
+
+An index is a function of a dict of band name -> (..., timesteps) arrays
+that only uses arithmetic, so that it's the same code for both frameworks.
+To add one, add it to INDICES with the bound its values are clipped to, or
+None if they don't need one.
+'''
+
+from . import feature_spec
+
+# Add a small constant in the denominators to ensure
+# NaNs don't occur because of missing data. Missing
+# data (i.e. Landsat 7 scan line failure) is represented as 0
+# in TFRecord files. Adding \{epsilon} will barely
+# change the non-missing data, and will make sure missing data
+# is still 0 when it's fed into the model.
+EPSILON = 1e-6
+# EVI is clipped to [-EVI_BOUND, EVI_BOUND]: its denominator goes to 0 over
+# bright blue pixels (haze, snow), and cached indices are stored as int16
+# in units of 0.0001 (see utils.quantize_features).
+EVI_BOUND = 3.0
+
+
+def _normalized_difference(a, b):
+    return lambda bands: (bands[a] - bands[b]) / (bands[a] + bands[b] + EPSILON)
+
+
+# name: (index, bound)
+INDICES = {
+        'ndvi': (_normalized_difference('nir', 'red'), None),
+        # Gao's NDWI, vegetation water content.
+        'ndwi': (_normalized_difference('nir', 'swir1'), None),
+        'evi': (lambda bands: 2.5 * (bands['nir'] - bands['red']) / \
+                (bands['nir'] + 6 * bands['red'] - 7.5 * bands['blue'] + 1), EVI_BOUND),
+        'savi': (lambda bands: 1.5 * (bands['nir'] - bands['red']) / \
+                (bands['nir'] + bands['red'] + 0.5), None),
+        }
+
+
+def index_names(add_ndvi):
+    '''
+    The data_settings.add_ndvi option as a list of index names: False adds
+    none, True adds NDVI, and a name or list of names adds those.
+    '''
+    if not add_ndvi:
+        return []
+    if add_ndvi is True:
+        return ['ndvi']
+    if isinstance(add_ndvi, str):
+        return [add_ndvi]
+    return list(add_ndvi)
+
+
+def band_channels(band, features=None):
+    '''
+    Channel of band at each timestep in a stack of sorted features.
+    '''
+    if features is None:
+        features = feature_spec.features()
+    features = sorted(features)
+    channels = []
+    t = 0
+    while '{}_{}_mean'.format(t, band) in features:
+        channels.append(features.index('{}_{}_mean'.format(t, band)))
+        t += 1
+    return channels
+
+
+class _Bands(dict):
+    # gathers each band the first time an index asks for it.
+    def __init__(self, gather, features):
+        self.gather = gather
+        self.features = features
+
+    def __missing__(self, band):
+        channels = band_channels(band, self.features)
+        if not channels:
+            raise KeyError('no {} band in the feature stack'.format(band))
+        self[band] = self.gather(channels)
+        return self[band]
+
+
+def _compute(gather, clip, names, features):
+    bands = _Bands(gather, features)
+    out = []
+    for name in names:
+        index, bound = INDICES[name]
+        out.append(index(bands) if bound is None else clip(index(bands), -bound, bound))
+    return out
+
+
+def tf_indices(image_stack, names, features=None):
+    '''
+    (..., len(names) * timesteps) tensor of the indices in names for every
+    timestep of a channels-last stack of sorted features, ordered by index,
+    then timestep.
+    '''
+    gather = lambda channels: tf.gather(image_stack, channels, axis=-1)
+    return tf.concat(_compute(gather, tf.clip_by_value, names, features), axis=-1)
+
+
+def numpy_indices(image_stack, names, features=None, axis=0):
+    '''
+    tf_indices for NumPy arrays with channels on axis.
+    '''
+    gather = lambda channels: np.take(image_stack, channels, axis=axis)
+    return np.concatenate(_compute(gather, np.clip, names, features), axis=axis)
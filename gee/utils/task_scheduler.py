@@ -0,0 +1,194 @@
+import os
+import json
+import time
+'''
+Throttled scheduler for Earth Engine export tasks.
+
+Tasks are queued as (key, make_task) pairs, where make_task returns a new,
+unstarted ee.batch.Task (e.g. a call to ee.batch.Export.image.toCloudStorage).
+At most max_running tasks are kept in the READY/RUNNING states. Tasks that
+fail to start (e.g. the account's task queue is full) or that fail on the
+server are retried with exponential backoff. The state of every key is saved
+to queue_file, so an interrupted extraction picks up where it left off:
+completed keys are skipped and submitted tasks are polled by id instead of
+being started again.
+
+Nothing in here imports ee, so it can be run against a fake of ee.batch.
+'''
+
+PENDING = 'PENDING'
+SUBMITTED = 'SUBMITTED'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+
+# states of ee.batch.Task.status()['state'] that end a task unsuccessfully
+FAILED_STATES = ('FAILED', 'CANCELLED')
+
+
+class TaskScheduler:
+
+    def __init__(self, max_running=10, poll_interval=30, max_retries=5,
+            base_backoff=30, max_backoff=3000, queue_file=None,
+            start_exceptions=(Exception,), get_status=None,
+            sleep=time.sleep, clock=time.time, verbose=True):
+        '''
+        max_running: maximum number of submitted tasks that are not finished.
+        poll_interval: seconds between status polls.
+        max_retries: number of times a task is retried (after failing to
+            start or failing on the server) before it is given up on.
+        base_backoff, max_backoff: a task's n-th retry waits
+            min(base_backoff * 2**(n-1), max_backoff) seconds.
+        queue_file: json file the queue is persisted to, if not None.
+        start_exceptions: exceptions from task.start() that are retried,
+            e.g. (ee.ee_exception.EEException,).
+        get_status: function of a task id returning the task's status dict,
+            e.g. lambda i: ee.data.getTaskStatus(i)[0]. Used for tasks that
+            were submitted before a resume.
+        '''
+        self.max_running = max_running
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.queue_file = queue_file
+        self.start_exceptions = start_exceptions
+        self.get_status = get_status
+        self.sleep = sleep
+        self.clock = clock
+        self.verbose = verbose
+
+        self.records = {}
+        self.factories = {}
+        self.tasks = {}
+        self.order = []
+        if queue_file is not None and os.path.isfile(queue_file):
+            with open(queue_file) as f:
+                self.records = json.load(f)
+        self.n_completed = 0
+        self.start_time = None
+
+
+    def add(self, key, make_task):
+        '''
+        Queues the task made by make_task under key. Keys completed in a
+        previous run are skipped; keys submitted in a previous run are
+        polled by their task id.
+        '''
+        record = self.records.get(key)
+        if record is None:
+            record = {'state': PENDING, 'task_id': None, 'attempts': 0, 'next_attempt': 0}
+            self.records[key] = record
+        elif record['state'] == FAILED:
+            # given up on in an earlier run, try again.
+            record.update({'state': PENDING, 'task_id': None, 'attempts': 0, 'next_attempt': 0})
+        self.factories[key] = make_task
+        if key not in self.order:
+            self.order.append(key)
+
+
+    def run(self):
+        '''
+        Starts and polls tasks until every queued key is completed or has
+        exhausted its retries. Returns the list of failed keys.
+        '''
+        self.start_time = self.clock()
+        self.n_completed = 0
+        while True:
+            self._poll()
+            self._start_pending()
+            self._save()
+            self._report()
+            if not self._unfinished():
+                break
+            self.sleep(self.poll_interval)
+
+        failed = [k for k in self.order if self.records[k]['state'] == FAILED]
+        for key in failed:
+            print('giving up on task {}'.format(key))
+        return failed
+
+
+    def _unfinished(self):
+        return [k for k in self.order if self.records[k]['state'] in (PENDING, SUBMITTED)]
+
+
+    def _running(self):
+        return [k for k in self.order if self.records[k]['state'] == SUBMITTED]
+
+
+    def _status(self, key):
+        record = self.records[key]
+        if key in self.tasks:
+            return self.tasks[key].status()
+        if self.get_status is None:
+            raise ValueError('task {} was submitted in an earlier run, pass get_status'
+                    ' to poll it'.format(key))
+        return self.get_status(record['task_id'])
+
+
+    def _poll(self):
+        for key in self._running():
+            state = self._status(key)['state']
+            if state == 'COMPLETED':
+                self.records[key]['state'] = COMPLETED
+                self.tasks.pop(key, None)
+                self.n_completed += 1
+            elif state in FAILED_STATES:
+                self.tasks.pop(key, None)
+                self._retry(key, 'task ended in state {}'.format(state))
+
+
+    def _retry(self, key, reason):
+        record = self.records[key]
+        record['attempts'] += 1
+        record['task_id'] = None
+        if record['attempts'] > self.max_retries:
+            record['state'] = FAILED
+            return
+        backoff = min(self.base_backoff * 2**(record['attempts'] - 1), self.max_backoff)
+        record['state'] = PENDING
+        record['next_attempt'] = self.clock() + backoff
+        if self.verbose:
+            print('{}: {}, retrying in {}s'.format(key, reason, backoff))
+
+
+    def _start_pending(self):
+        n_running = len(self._running())
+        now = self.clock()
+        for key in self.order:
+            if n_running >= self.max_running:
+                break
+            record = self.records[key]
+            if record['state'] != PENDING or record['next_attempt'] > now:
+                continue
+            task = self.factories[key]()
+            try:
+                task.start()
+            except self.start_exceptions as e:
+                self._retry(key, e)
+                # the server is refusing tasks, so don't start any others
+                # until the next poll.
+                break
+            record['state'] = SUBMITTED
+            record['task_id'] = task.id
+            self.tasks[key] = task
+            n_running += 1
+
+
+    def _save(self):
+        if self.queue_file is None:
+            return
+        tmp = self.queue_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.records, f)
+        os.replace(tmp, self.queue_file)
+
+
+    def _report(self):
+        if not self.verbose:
+            return
+        states = [self.records[k]['state'] for k in self.order]
+        elapsed = max(self.clock() - self.start_time, 1e-9)
+        print('tasks: {} completed, {} running, {} pending, {} failed, {:.1f} completed/hour'.format(
+            states.count(COMPLETED), states.count(SUBMITTED), states.count(PENDING),
+            states.count(FAILED), 3600 * self.n_completed / elapsed))
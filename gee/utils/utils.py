@@ -1,61 +1,63 @@
 import numpy as np
 import time
 import os
+import hashlib
 import tensorflow as tf
 import tensorflow
 from collections import defaultdict
 from random import shuffle
-from scipy.ndimage.morphology import distance_transform_edt
 
 
 from . import feature_spec
+from . import spectral_indices
 
 
 features_dict = feature_spec.features_dict()
 BANDS = feature_spec.bands() # includes mask raster
 FEATURES = feature_spec.features() # only input features
-NDVI_INDICES = [(2, 3), (8, 9), (14, 15), (20, 21), (26, 27), (32, 33)]
+# keys of the stacked, quantized features and spectral indices in cached records.
+# See quantize_features.
+QUANTIZED_KEY = 'quantized_stack'
+QUANTIZED_INDICES_KEY = 'quantized_indices'
 
-def tf_distance_map(mask):
-    im_shape = mask.shape
-    mask = tf.cast(mask, tf.bool)
-    mask = tf.math.logical_not(mask) # make the non-masked areas masked
-    [mask,] = tf.py_function(distance_map, [mask], [tf.float32])
-    mask.set_shape(im_shape)
-    return mask
+def one_hot(labels, n_classes):
+    # label rasters are 1-indexed, with 0 as nodata. Works on single
+    # (h, w) label rasters and on batches of them.
+    return tf.one_hot(tf.cast(labels, tf.int32) - 1, n_classes)
 
-def distance_map(mask):
-    mask = distance_transform_edt(mask) 
-    mask[0, 0] = 0
-    return mask
 
-def one_hot(labels, n_classes):
-    h, w = labels.shape
-    ls = []
-    for i in range(n_classes):
-        ls.append(tf.where(labels == i+1, tf.ones((h, w)), tf.zeros((h, w))))
-    return tf.stack(ls, axis=-1)
+def border_mask(mask):
+    '''
+    Pixels outside of mask that share an edge with a pixel in mask, i.e. the
+    pixels at distance 1 in a euclidean distance transform of ~mask.
+    Computed as a dilation with a 3x3 cross (two max pools), so it runs
+    in graph mode on (h, w) masks and on (n, h, w) batches of them.
+    '''
+    mask = tf.cast(mask, tf.float32)
+    single = len(mask.shape) == 2
+    if single:
+        mask = mask[tf.newaxis]
+    x = mask[..., tf.newaxis]
+    vertical = tf.nn.max_pool2d(x, ksize=(3, 1), strides=1, padding='SAME')
+    horizontal = tf.nn.max_pool2d(x, ksize=(1, 3), strides=1, padding='SAME')
+    border = tf.maximum(vertical, horizontal)[..., 0] * (1 - mask)
+    if single:
+        border = border[0]
+    return border
 
 
 def one_hot_border_labels(labels, n_classes):
-    h, w = labels.shape
-    labels = tf.squeeze(labels)
-    ls = []
-    border_labels = None
-    for i in range(n_classes):
-        if i == 0:
-            # informative names, here
-            where = tf.where(labels != i+1, tf.zeros((h, w)), 1*tf.ones((h,w)))
-            border_labels = tf_distance_map(where)
-            border_labels = tf.where(border_labels != i+1, tf.zeros((h, w)), tf.ones((h,w)))
-        elif i == 2 and border_labels is not None:
-            where = tf.where(labels != i+1, tf.zeros((h, w)), tf.ones((h,w)))
-            where = tf.where(border_labels == 1, tf.ones((h, w)), where)
-        else:
-            where = tf.where(labels != i+1, tf.zeros((h, w)), tf.ones((h,w)))
-        ls.append(where)
-    temp = tf.stack(ls, axis=-1)
-    return temp
+    '''
+    one_hot, with the one pixel border around irrigated (class 0) fields
+    also labeled as class 2.
+    '''
+    one_hot_labels = one_hot(labels, n_classes)
+    if n_classes < 3:
+        return one_hot_labels
+    border_labels = border_mask(one_hot_labels[..., 0])
+    class_two = tf.maximum(one_hot_labels[..., 2], border_labels)
+    return tf.concat((one_hot_labels[..., :2], class_two[..., tf.newaxis],
+        one_hot_labels[..., 3:]), axis=-1)
 
 
 def mask_unlabeled_values(y_true, y_pred):
@@ -101,59 +103,176 @@ def confusion_matrix_from_generator(datasets, batch_size, model, n_classes):
     return out_cmat, recall_dict, precision_dict, instance_count
 
 
-def get_shared_dataset(pattern, add_ndvi, n_classes):
+def streaming_confusion_matrices(dataset, models, n_classes, n_groups=1):
+    '''
+    Confusion matrices of every model in models, accumulated on device in
+    one pass over dataset.
+    inputs: dataset of batched (features, labels, group) tuples, where labels
+    are one-hot (all 0s is nodata) and group is an int32 per example in
+    [0, n_groups), e.g. the index of the year the example is from.
+    models: list of SavedModel signatures (or other callables) returning
+    {'softmax': ...}.
+    Returns an int64 array of shape (n_groups, len(models), n_classes, n_classes),
+    rows are labels and columns are predictions.
+    '''
+    n_models = len(models)
+    size = n_groups*n_models*n_classes*n_classes
+    cmats = tf.Variable(tf.zeros(size, dtype=tf.int64), trainable=False)
+
+    @tf.function
+    def _accumulate(features, labels, groups):
+        mask = tf.not_equal(tf.reduce_sum(labels, axis=-1), 0)
+        y_true = tf.argmax(labels, axis=-1, output_type=tf.int32)
+        # one group per example, broadcast over its pixels.
+        groups = tf.reshape(tf.cast(groups, tf.int32),
+                tf.concat(([-1], tf.ones(tf.rank(y_true) - 1, tf.int32)), axis=0))
+        groups = tf.broadcast_to(groups, tf.shape(y_true))
+        y_true = tf.boolean_mask(y_true, mask)
+        groups = tf.boolean_mask(groups, mask)
+        for m, model in enumerate(models):
+            y_pred = tf.argmax(model(features)['softmax'], axis=-1, output_type=tf.int32)
+            y_pred = tf.boolean_mask(y_pred, mask)
+            flat = ((groups*n_models + m)*n_classes + y_true)*n_classes + y_pred
+            cmats.assign_add(tf.math.bincount(flat, minlength=size, maxlength=size,
+                dtype=tf.int64))
+
+    for features, labels, groups in dataset:
+        _accumulate(features, labels, groups)
+    return cmats.numpy().reshape(n_groups, n_models, n_classes, n_classes)
+
+
+def precision_and_recall(cmat):
+    '''
+    Per-class precision and recall of a confusion matrix with labels as rows
+    and predictions as columns. Classes that never occur give nan.
+    '''
+    cmat = np.asarray(cmat, dtype=np.float64)
+    tp = np.diag(cmat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tp / cmat.sum(axis=0)
+        recall = tp / cmat.sum(axis=1)
+    return precision, recall
+
+
+def _tfrecord_dataset(pattern, deterministic, num_parallel_reads, shuffle_files=True):
+    if not isinstance(pattern, list):
+        files = tf.io.gfile.glob(pattern)
+    else:
+        files = list(pattern)
+    if shuffle_files:
+        shuffle(files)
+    else:
+        files = sorted(files)
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    return dataset.interleave(
+            lambda f: tf.data.TFRecordDataset(f, compression_type='GZIP'),
+            cycle_length=num_parallel_reads,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=deterministic)
+
+
+def _cache_path(cache_directory, files, prefix):
+    # one cache per set of input files; the order they're read in doesn't matter.
+    digest = hashlib.md5('\n'.join(sorted(files)).encode('utf-8')).hexdigest()
+    return os.path.join(cache_directory, '{}-{}'.format(prefix, digest))
+
+
+def _parse_and_format(dataset, to_tuple_fn, parse_batch_size, deterministic,
+        cache_path=None, cache_indices=()):
+    if parse_batch_size:
+        # parse and format parse_batch_size records at a time,
+        # then hand individual examples on to shuffling/sampling.
+        dataset = dataset.batch(parse_batch_size)
+        parse_fn = parse_tfrecord_batch
+    else:
+        parse_fn = parse_tfrecord
+
+    dataset = dataset.map(parse_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=deterministic)
+
+    if cache_path is not None:
+        # the first pass decompresses, parses and writes the quantized stacks;
+        # later epochs (and later runs over the same files) read them back.
+        dataset = dataset.map(lambda inputs: quantize_features(inputs, cache_indices),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=deterministic)
+        # Snappy, the default, writes snapshots that a new process can't read
+        # back once records are over 256KB.
+        dataset = dataset.snapshot(cache_path, compression='GZIP')
+
+    dataset = dataset.map(to_tuple_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=deterministic)
+    if parse_batch_size:
+        dataset = dataset.unbatch()
+    return dataset
+
+
+def get_shared_dataset(pattern, add_ndvi, n_classes, parse_batch_size=None,
+        deterministic=True, num_parallel_reads=tf.data.experimental.AUTOTUNE,
+        cache_directory=None):
     """Function to read, parse and format to tuple a set of input tfrecord files.
     Get all the files matching the pattern, parse and convert to tuple.
     Args:
       pattern: A file pattern to match in a Cloud Storage bucket,
                or list of GCS files
       add_ndvi:  Whether or not to add ndvi to the feature stak, computed on the fly.
+      parse_batch_size: If set, records are parsed and formatted in batches of
+                 this size with tf.io.parse_example, then unbatched.
+      deterministic: Set to False to let parallel reads and maps return elements
+                 out of order for higher throughput.
+      num_parallel_reads: Number of files read concurrently.
+      cache_directory: If set, parsed records are quantized and snapshotted
+                 under this directory (see quantize_features), and read from
+                 there on later passes.
 
       Returns:
       A tf.data.Dataset
     """
-    if not isinstance(pattern, list):
-        files = tf.io.gfile.glob(pattern)
-        shuffle(files)
-        dataset = tf.data.TFRecordDataset(files, compression_type='GZIP',
-                num_parallel_reads=tf.data.experimental.AUTOTUNE)
-    else:
-        shuffle(pattern)
-        dataset = tf.data.TFRecordDataset(pattern, compression_type='GZIP',
-                num_parallel_reads=tf.data.experimental.AUTOTUNE)
-
-    dataset = dataset.map(parse_tfrecord, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    cache_path = None
+    if cache_directory is not None:
+        files = pattern if isinstance(pattern, list) else tf.io.gfile.glob(pattern)
+        cache_path = _cache_path(cache_directory, files, 'shared')
+    dataset = _tfrecord_dataset(pattern, deterministic, num_parallel_reads,
+            shuffle_files=cache_path is None)
     to_tuple_fn = to_shared_tuple(add_ndvi, n_classes)
-    dataset = dataset.map(to_tuple_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    return dataset
+    return _parse_and_format(dataset, to_tuple_fn, parse_batch_size, deterministic,
+            cache_path=cache_path)
 
 
-def get_dataset(pattern, add_ndvi, n_classes, border_labels):
+def get_dataset(pattern, add_ndvi, n_classes, border_labels, parse_batch_size=None,
+        deterministic=True, num_parallel_reads=tf.data.experimental.AUTOTUNE,
+        cache_directory=None):
     """Function to read, parse and format to tuple a set of input tfrecord files.
     Get all the files matching the pattern, parse and convert to tuple.
     Args:
       pattern: A file pattern to match in a Cloud Storage bucket,
                or list of GCS files
       add_ndvi:  Whether or not to add ndvi to the feature stak, computed on the fly.
+                 A list of names from spectral_indices.INDICES adds those indices.
+                 With a cache_directory the indices are computed once and cached.
       n_classes: The number of classes in the segmentation dataset, used 
                  to define the shape of the one hot matrix.
+      parse_batch_size: If set, records are parsed and formatted in batches of
+                 this size with tf.io.parse_example, then unbatched.
+      deterministic: Set to False to let parallel reads and maps return elements
+                 out of order for higher throughput.
+      num_parallel_reads: Number of files read concurrently.
+      cache_directory: If set, parsed records are quantized and snapshotted
+                 under this directory (see quantize_features), and read from
+                 there on later passes.
     Returns:
       A tf.data.Dataset
     """
-    if not isinstance(pattern, list):
-        files = tf.io.gfile.glob(pattern)
-        shuffle(files)
-        dataset = tf.data.TFRecordDataset(files, compression_type='GZIP',
-                num_parallel_reads=tf.data.experimental.AUTOTUNE)
-    else:
-        shuffle(pattern)
-        dataset = tf.data.TFRecordDataset(pattern, compression_type='GZIP',
-                num_parallel_reads=tf.data.experimental.AUTOTUNE)
-
-    dataset = dataset.map(parse_tfrecord, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    cache_path = None
+    if cache_directory is not None:
+        files = pattern if isinstance(pattern, list) else tf.io.gfile.glob(pattern)
+        cache_path = _cache_path(cache_directory, files,
+                '-'.join(['unet'] + spectral_indices.index_names(add_ndvi)))
+    dataset = _tfrecord_dataset(pattern, deterministic, num_parallel_reads,
+            shuffle_files=cache_path is None)
     to_tuple_fn = to_tuple(add_ndvi, n_classes, border_labels)
-    dataset = dataset.map(to_tuple_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    return dataset
+    return _parse_and_format(dataset, to_tuple_fn, parse_batch_size, deterministic,
+            cache_path=cache_path, cache_indices=spectral_indices.index_names(add_ndvi))
 
 
 def parse_tfrecord(example_proto):
@@ -167,6 +286,50 @@ def parse_tfrecord(example_proto):
     return tf.io.parse_single_example(example_proto, features_dict)
 
 
+def parse_tfrecord_batch(example_protos):
+    """Batched version of parse_tfrecord.
+    args:
+      example_protos: a 1-D tensor of serialized examples.
+    returns:
+      a dictionary of tensors with a leading batch dimension, keyed by feature name.
+    """
+    return tf.io.parse_example(example_protos, features_dict)
+
+
+def _stack_features(inputs):
+    # stack on the last axis, which gives HWC for single examples and
+    # NHWC for batches without a transpose.
+    if QUANTIZED_KEY in inputs:
+        return tf.cast(inputs[QUANTIZED_KEY], tf.float32) * 0.0001
+    features_list = [inputs.get(key) for key in sorted(FEATURES)]
+    return tf.stack(features_list, axis=-1) * 0.0001
+
+
+def _quantize(x):
+    return tf.cast(tf.clip_by_value(tf.round(x), -32768, 32767), tf.int16)
+
+
+def quantize_features(inputs, indices=()):
+    """
+    Stacks the parsed features into one int16 tensor, before the 0.0001
+    scale is applied, and casts the label raster to uint8. The composites are
+    means of surface reflectance, so values are rounded to the nearest
+    integer reflectance unit. int16 rather than uint16, since surface
+    reflectance can be slightly negative. This halves the size
+    of cached records; _stack_features scales them back at read time.
+    The spectral indices named in indices are computed here as well and
+    stored at the same 0.0001 resolution, so they're only computed once.
+    """
+    features_list = [inputs.get(key) for key in sorted(FEATURES)]
+    stacked = tf.stack(features_list, axis=-1)
+    out = {QUANTIZED_KEY: _quantize(stacked),
+           'constant': tf.cast(inputs.get('constant'), tf.uint8)}
+    if len(indices):
+        out[QUANTIZED_INDICES_KEY] = _quantize(
+                spectral_indices.tf_indices(stacked * 0.0001, indices) * 10000)
+    return out
+
+
 def to_shared_tuple(add_ndvi, n_classes):
     """
     Function to convert a dictionary of tensors to a tuple of (inputs, outputs).
@@ -177,13 +340,10 @@ def to_shared_tuple(add_ndvi, n_classes):
       slices of the input tensor with channel dimension 6.
     """
     def _to_tuple(inputs):
-        features_list = [inputs.get(key) for key in sorted(FEATURES)]
-        stacked = tf.stack(features_list, axis=0)
-        # Convert from CHW to HWC
-        stacked = tf.transpose(stacked, [1, 2, 0]) * 0.0001
+        stacked = _stack_features(inputs)
         out = []
         for i in range(6, stacked.shape[-1]+6, 6):
-            out.append(stacked[:, :, i-6:i])
+            out.append(stacked[..., i-6:i])
         # 'constant' is the label for label raster. 
         labels = one_hot(inputs.get('constant'), n_classes=n_classes)
         return (out[0], out[1], out[2], out[3], out[4], out[5]), labels
@@ -194,17 +354,18 @@ def to_tuple(add_ndvi, n_classes, border_labels):
     """
     Function to convert a dictionary of tensors to a tuple of (inputs, outputs).
     Turn the tensors returned by parse_tfrecord into a stack in HWC shape.  
+    Works on single parsed examples and on batches from parse_tfrecord_batch.
     Args: inputs: A dictionary of tensors, keyed by feature name.
     Returns:
       A tuple of (inputs, outputs).
     """
     def _to_tuple(inputs):
-        features_list = [inputs.get(key) for key in sorted(FEATURES)]
-        stacked = tf.stack(features_list, axis=0)
-        # Convert from CHW to HWC
-        stacked = tf.transpose(stacked, [1, 2, 0]) * 0.0001
-        if add_ndvi:
-            image_stack = add_ndvi_raster(stacked)
+        stacked = _stack_features(inputs)
+        if QUANTIZED_INDICES_KEY in inputs:
+            cached = tf.cast(inputs[QUANTIZED_INDICES_KEY], tf.float32) * 0.0001
+            image_stack = tf.concat((stacked, cached), axis=-1)
+        elif add_ndvi:
+            image_stack = add_spectral_indices(stacked, spectral_indices.index_names(add_ndvi))
         else:
             image_stack = stacked
         # 'constant' is the label for label raster. 
@@ -217,37 +378,20 @@ def to_tuple(add_ndvi, n_classes, border_labels):
     return _to_tuple
 
 
-def add_ndvi_raster(image_stack):
+def add_spectral_indices(image_stack, names):
+    '''
+    Appends the spectral indices in names (see spectral_indices.INDICES) for
+    all six timesteps to a channels-last stack of sorted features, computed
+    at once for single examples and for batches.
+    '''
+    return tf.concat((image_stack, spectral_indices.tf_indices(image_stack, names)), axis=-1)
 
+
+def add_ndvi_raster(image_stack):
     '''
-    These indices are hardcoded, and taken from the
-    sorted keys in feature_spec.
-    (NIR - Red) / (NIR + Red)
-        2 0_nir_mean
-        3 0_red_mean
-        8 1_nir_mean
-        9 1_red_mean
-        14 2_nir_mean
-        15 2_red_mean
-        20 3_nir_mean
-        21 3_red_mean
-        26 4_nir_mean
-        27 4_red_mean
-        32 5_nir_mean
-        33 5_red_mean
+    (NIR - Red) / (NIR + Red) for every timestep, appended to image_stack.
     '''
-    out = []
-    for nir_idx, red_idx in NDVI_INDICES:
-        # Add a small constant in the denominator to ensure
-        # NaNs don't occur because of missing data. Missing
-        # data (i.e. Landsat 7 scan line failure) is represented as 0
-        # in TFRecord files. Adding \{epsilon} will barely 
-        # change the non-missing data, and will make sure missing data
-        # is still 0 when it's fed into the model.
-        ndvi = (image_stack[:,:, nir_idx] - image_stack[:,:, red_idx]) /\
-                (image_stack[:,:, nir_idx] + image_stack[:,:, red_idx] + 1e-6) 
-        out.append(ndvi)
-    return tf.concat((image_stack, tf.stack(out, axis=-1)), axis=-1)
+    return add_spectral_indices(image_stack, ['ndvi'])
 
 
 def filter_list_into_classes(lst):
@@ -286,7 +430,10 @@ def make_validation_dataset(root,
         n_classes,
         buffer_size,
         temporal_unet,
-        border_labels):
+        border_labels,
+        parse_batch_size=None,
+        deterministic=True,
+        cache_directory=None):
 
     pattern = "*gz"
     training_root = os.path.join(root, pattern)
@@ -297,12 +444,60 @@ def make_validation_dataset(root,
         print('Length of validation files after removing year {}: {}'.format(year, len(files)))
 
     if temporal_unet:
-        datasets = get_shared_dataset(files, add_ndvi, n_classes)
+        datasets = get_shared_dataset(files, add_ndvi, n_classes,
+                parse_batch_size=parse_batch_size, deterministic=deterministic,
+                cache_directory=cache_directory)
     else:
-        datasets = get_dataset(files, add_ndvi, n_classes, border_labels)
+        datasets = get_dataset(files, add_ndvi, n_classes, border_labels,
+                parse_batch_size=parse_batch_size, deterministic=deterministic,
+                cache_directory=cache_directory)
     datasets = datasets.shuffle(buffer_size).batch(batch_size).shuffle(buffer_size)
     return datasets
 
+def make_grouped_validation_dataset(root,
+        add_ndvi,
+        batch_size,
+        years,
+        n_classes,
+        temporal_unet,
+        border_labels,
+        parse_batch_size=None,
+        deterministic=True,
+        cache_directory=None):
+    '''
+    Validation dataset of (features, labels, group) batches, for
+    streaming_confusion_matrices. group is the index into years of the year
+    each example's file belongs to; if years is None all files are group 0.
+    Each file is read once and nothing is shuffled.
+    '''
+    files = tf.io.gfile.glob(os.path.join(root, "*gz"))
+    if years is None:
+        file_groups = [files]
+    else:
+        file_groups = [[f for f in files if year in f] for year in years]
+
+    dataset = None
+    for group, group_files in enumerate(file_groups):
+        if not len(group_files):
+            print('no validation files for group {}'.format(years[group]))
+            continue
+        if temporal_unet:
+            group_dataset = get_shared_dataset(group_files, add_ndvi, n_classes,
+                    parse_batch_size=parse_batch_size, deterministic=deterministic,
+                    cache_directory=cache_directory)
+        else:
+            group_dataset = get_dataset(group_files, add_ndvi, n_classes, border_labels,
+                    parse_batch_size=parse_batch_size, deterministic=deterministic,
+                    cache_directory=cache_directory)
+        group_dataset = group_dataset.map(
+                lambda features, labels, group=group: (features, labels, tf.constant(group)))
+        dataset = group_dataset if dataset is None else dataset.concatenate(group_dataset)
+
+    if dataset is None:
+        raise ValueError('no validation files in {} for years {}'.format(root, years))
+    return dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+
 def make_balanced_training_dataset(root,
                                    add_ndvi,
                                    batch_size, 
@@ -312,7 +507,10 @@ def make_balanced_training_dataset(root,
                                    n_classes,
                                    temporal_unet,
                                    border_labels,
-                                   bootstrap):
+                                   bootstrap,
+                                   parse_batch_size=None,
+                                   deterministic=True,
+                                   cache_directory=None):
 
     pattern = "*gz"
     datasets = []
@@ -332,9 +530,13 @@ def make_balanced_training_dataset(root,
 
     for class_name, file_list in files.items():
         if temporal_unet:
-            dataset = get_shared_dataset(file_list, add_ndvi, n_classes)
+            dataset = get_shared_dataset(file_list, add_ndvi, n_classes,
+                    parse_batch_size=parse_batch_size, deterministic=deterministic,
+                    cache_directory=cache_directory)
         else:
-            dataset = get_dataset(file_list, add_ndvi, n_classes, border_labels)
+            dataset = get_dataset(file_list, add_ndvi, n_classes, border_labels,
+                    parse_batch_size=parse_batch_size, deterministic=deterministic,
+                    cache_directory=cache_directory)
 
         datasets.append(dataset.shuffle(buffer_size).repeat())
         weights.append(_assign_weight(class_name))
@@ -19,6 +19,8 @@ import sys
 from copy import deepcopy
 from datetime import datetime
 from multiprocessing import cpu_count
+from shutil import rmtree
+from tempfile import mkdtemp
 
 from multiprocessing.pool import Pool
 from numpy.core.multiarray import concatenate
@@ -27,15 +29,15 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import numpy as np
 import tensorflow as tf
 from numpy import load, save
-from numpy import zeros, array, float16, ndarray, array_split, float64
+from numpy import zeros, array, float16, ndarray, array_split
 from numpy.ma import array as marray
-from sklearn.preprocessing import StandardScaler
 from rasterio import open as rasopen
 from rasterio.dtypes import float32
 
 from sat_image.warped_vrt import warp_single_image
 from pixel_classification.prepare_images import ImageStack
-from pixel_classification.tf_multilayer_perceptron import multilayer_perceptron
+from pixel_classification.tf_multilayer_perceptron import multilayer_perceptron, streaming_moments, \
+    load_statistics
 
 import warnings
 from sklearn.exceptions import DataConversionWarning
@@ -111,6 +113,7 @@ class Classifier(object):
         if isinstance(image_data, str):
             self.saved_array = image_data
             stack = load(image_data)
+            stack[stack == 0.] = np.nan # for "borders"
 
         elif isinstance(image_data, ImageStack):
             self.data = image_data
@@ -122,7 +125,6 @@ class Classifier(object):
 
         self.final_shape = 1, stack.shape[1], stack.shape[2]
         stack = stack.reshape((stack.shape[0], stack.shape[1] * stack.shape[2]))
-        stack[stack == 0.] = np.nan # for "borders"
 
         if mask_path:
             ms = self.mask.shape
@@ -135,18 +137,12 @@ class Classifier(object):
 
         self.new_array = zeros((1, self.masked_data_stack.shape[1]), dtype=float16)
 
-    def classify(self, arr=None):
-
-        sess = tf.Session()
-        saver = tf.train.import_meta_graph('{}.meta'.format(self.model))
-        saver.restore(sess, self.model)
-        self.pixel = tf.placeholder("float", [None, self.n])
-
-        wh = sess.graph.get_tensor_by_name('Wh:0')
-        wo = sess.graph.get_tensor_by_name('Wo:0')
-        bh = sess.graph.get_tensor_by_name('Bh:0')
-        bo = sess.graph.get_tensor_by_name('Bo:0')
-        classifier = tf.add(tf.matmul(multilayer_perceptron(self.pixel, wh, bh), wo), bo)
+    def classify(self, arr=None, batch_size=65536):
+        """ Classify every unmasked pixel (column) of the masked data stack.
+        Pixels are fed through the restored graph batch_size at a time, and the
+        argmax is taken in the graph; masked pixels are set to nan.
+        """
+        sess, prediction = self.restore_model()
 
         if isinstance(arr, ndarray):
             if len(arr.shape) > 2:
@@ -156,26 +152,44 @@ class Classifier(object):
             else:
                 raise AttributeError('Invalid shape')
 
-        g = tf.get_default_graph()
-
-        if not self.new_array:
-            self.new_array = zeros((1, self.masked_data_stack.shape[1]), dtype=float16)
-
-        for i in range(self.masked_data_stack.shape[-1]):
-            if not np.ma.is_masked(self.masked_data_stack[:, i]):
-                dat = self.masked_data_stack[:, i]
-                dat = array(dat).reshape((1, dat.shape[0]))
-                loss = sess.run(classifier, feed_dict={self.pixel: dat})
-                self.new_array[0, i] = np.argmax(loss, 1)
-            else:
-                self.new_array[0, i] = np.nan
+        # a pixel is classified only if none of its features are masked
+        valid = ~np.ma.getmaskarray(self.masked_data_stack).any(axis=0)
+        data = np.ma.getdata(self.masked_data_stack)
+        self.new_array = self.predict(sess, prediction, data, valid,
+                                      batch_size=batch_size).reshape(1, -1)
 
         sess.close()
 
-        self.new_array = array(self.new_array, dtype=float32)
-
         return Result(self.idx, self.new_array)
 
+    def restore_model(self):
+        """ Restore the checkpoint at self.model into a session, and build the
+        argmax prediction op for pixel vectors of length self.n.
+        """
+        sess = tf.Session()
+        saver = tf.train.import_meta_graph('{}.meta'.format(self.model))
+        saver.restore(sess, self.model)
+        self.pixel = tf.placeholder("float", [None, self.n])
+
+        wh = sess.graph.get_tensor_by_name('Wh:0')
+        wo = sess.graph.get_tensor_by_name('Wo:0')
+        bh = sess.graph.get_tensor_by_name('Bh:0')
+        bo = sess.graph.get_tensor_by_name('Bo:0')
+        classifier = tf.add(tf.matmul(multilayer_perceptron(self.pixel, wh, bh), wo), bo)
+        return sess, tf.argmax(classifier, 1)
+
+    def predict(self, sess, prediction, data, valid, batch_size=65536):
+        """ Classes of the valid columns of data (features x pixels),
+        batch_size pixels per run; nan for invalid pixels.
+        """
+        pixels = np.flatnonzero(valid)
+        out = np.full(data.shape[1], np.nan, dtype=float32)
+        for start in range(0, pixels.size, batch_size):
+            batch = pixels[start:start + batch_size]
+            dat = data[:, batch].T.astype(float32)
+            out[batch] = sess.run(prediction, feed_dict={self.pixel: dat})
+        return out
+
     def write_raster(self, out_file, new_array=None):
 
         if isinstance(new_array, ndarray):
@@ -202,9 +216,16 @@ class Classifier(object):
         return arr
 
     def _get_stack_channels(self):
-
+        """ Stack of the standardized bands in paths_map, float32 with nan for
+        borders. Bands are standardized with the statistics saved with the model,
+        or with their own when the model has none.
+        """
         stack = None
         first = True
+        stats = load_statistics(self.model) if self.model else None
+        if stats is not None and len(stats[0]) != len(self.data.paths_map):
+            raise ValueError('{} has statistics of {} features, the stack has {}'.format(
+                self.model, len(stats[0]), len(self.data.paths_map)))
 
         for i, feat in enumerate(self.data.paths_map.keys()):
 
@@ -217,9 +238,9 @@ class Classifier(object):
                     break
             if first:
                 first_geo = deepcopy(self.raster_geo)
-                empty = zeros((len(self.data.paths_map.keys()), arr.shape[1], arr.shape[2]), float16)
+                empty = zeros((len(self.data.paths_map.keys()), arr.shape[1], arr.shape[2]), float32)
                 stack = empty
-                stack[i, :, :] = self.normalize_image_channel(arr)
+                stack[i, :, :] = arr
                 first = False
             else:
                 try:
@@ -229,27 +250,35 @@ class Classifier(object):
                     pprint.pprint(first_geo)
                     arr = warp_single_image(self.feature_ras, first_geo)
                     stack[i, :, :] = arr
+            del arr
+
+            if stats is None:
+                self.normalize_image_channel(stack[i])
+            else:
+                self.normalize_image_channel(stack[i], stats[0][i], stats[1][i])
 
         return stack
 
     @staticmethod
-    def normalize_image_channel(data):
-        data = data.reshape((data.shape[1], data.shape[2]))
-
-        data[data == np.nan] = 0.
-        data[data == np.inf] = 0.
-        scaler = StandardScaler()
-
-        try:
-            scaler = scaler.fit(data)
-            data = scaler.transform(data)
-        except ValueError:
-            # this handles large float arrays
-            data = data.astype(dtype=float64)
-            data = (data - np.nanmean(data)) / np.nanstd(data)
-
-        data = data.reshape((1, data.shape[0], data.shape[1]))
-        data = data.astype(dtype=float16)
+    def normalize_image_channel(data, mean=None, std=None, block_rows=512):
+        """ Standardizes a float32 band (rows x columns) in place, block_rows rows
+        at a time. Borders (0) and non-finite pixels are set to nan and left out
+        of the statistics, which are computed from the band in one pass if mean
+        and std aren't given.
+        """
+        data = data.reshape(data.shape[-2:])
+        blocks = [data[i:i + block_rows] for i in range(0, data.shape[0], block_rows)]
+        for block in blocks:
+            block[~np.isfinite(block) | (block == 0.)] = np.nan
+
+        if mean is None:
+            _, mean, std = streaming_moments(block.reshape(-1, 1) for block in blocks)
+            mean, std = mean[0], std[0]
+        std = std if std > 0 else 1.
+
+        for block in blocks:
+            block -= np.float32(mean)
+            block /= np.float32(std)
         return data
 
 
@@ -257,23 +286,66 @@ def get_classifier(obj, arr):
     return obj.classify(arr)
 
 
-def classify_multiproc(model, stack_data, result, array_outfile=None, mask=None):
-    d = Classifier()
+_WORKER = {}
+
+
+def _init_classify_worker(model, data_file, out_file, shape):
+    # runs once per worker: map the shared arrays and restore the model.
+    classifier = Classifier(model=model)
+    classifier.n = shape[0]
+    sess, prediction = classifier.restore_model()
+    _WORKER.update(classifier=classifier, sess=sess, prediction=prediction,
+                   data=np.memmap(data_file, dtype=float32, mode='r', shape=shape),
+                   out=np.memmap(out_file, dtype=float32, mode='r+', shape=(shape[1],)))
+
+
+def _classify_range(start, stop):
+    w = _WORKER
+    data = np.asarray(w['data'][:, start:stop])
+    valid = ~np.isnan(data).any(axis=0)
+    w['out'][start:stop] = w['classifier'].predict(w['sess'], w['prediction'], data, valid)
+    w['out'].flush()
+    return stop - start
+
+
+def classify_multiproc(model, stack_data, result, array_outfile=None, mask=None,
+                       pixels_per_task=2 ** 20, tmp_dir=None):
+    """ Classify a stack in a pool of workers.
+    The stack is written once, with masked values as nan, to a float32 memmap
+    that all workers map read-only, and each worker restores the model once.
+    Tasks are only (start, stop) pixel ranges, and workers write their
+    classes into a shared output memmap, so nothing scene-sized is pickled.
+    """
+    # with the model, bands are standardized with its training statistics
+    d = Classifier(model=model)
     d.get_stack(stack_data, outfile=array_outfile, mask_path=mask)
-    stack_data = d.masked_data_stack
-
-    cores = cpu_count()
-    a = ArrayDisAssembly(stack_data)
-    arrays = a.disassemble(n_sections=cores)
-    classifiers = [Classifier(idx=i, arr=a, model=model) for i, a in enumerate(arrays)]
-    time = datetime.now()
-    pool = Pool(processes=cores)
-    with pool as p:
-        pool_results = [p.apply_async(get_classifier, (c, a)) for a, c in zip(arrays, classifiers)]
-        classified_arrays = [res.get() for res in pool_results]
-        a.assemble(classified_arrays)
-        final = a.assembled.reshape(d.final_shape)
-    td = (datetime.now() - time)
+    stack = d.masked_data_stack
+    shape = stack.shape
+
+    tmp = mkdtemp(dir=tmp_dir)
+    data_file = os.path.join(tmp, 'stack.dat')
+    out_file = os.path.join(tmp, 'classes.dat')
+    try:
+        data = np.memmap(data_file, dtype=float32, mode='w+', shape=shape)
+        for i in range(shape[0]):
+            data[i] = np.ma.filled(stack[i].astype(float32), np.nan)
+        data.flush()
+        del data, stack
+        d.masked_data_stack = None
+        out = np.memmap(out_file, dtype=float32, mode='w+', shape=(shape[1],))
+        out[:] = np.nan
+        out.flush()
+
+        ranges = [(start, min(start + pixels_per_task, shape[1]))
+                  for start in range(0, shape[1], pixels_per_task)]
+        with Pool(processes=cpu_count(), initializer=_init_classify_worker,
+                  initargs=(model, data_file, out_file, shape)) as pool:
+            pool.starmap(_classify_range, ranges)
+
+        final = np.array(out).reshape(d.final_shape)
+        del out
+    finally:
+        rmtree(tmp, ignore_errors=True)
 
     d.write_raster(out_file=result, new_array=final)
 
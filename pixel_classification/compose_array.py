@@ -19,18 +19,26 @@ import sys
 
 abspath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(abspath)
-import pickle
 from copy import deepcopy
 from warnings import warn
 
 from fiona import open as fopen
-from numpy import linspace, max, nan, unique, ndarray
-from numpy.random import shuffle
-from pandas import DataFrame, Series
-from pyproj import Proj, transform
+from geopandas import read_file
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from numpy import max, nan, unique, ndarray, zeros, arange, atleast_1d, float64, int64
+from numpy import floor, full, asarray, empty, clip, isnan, isfinite, nonzero, float32
+from numpy import array, argsort, ceil, concatenate, cumsum, maximum, minimum
+from numpy.lib.stride_tricks import sliding_window_view
+from numpy.random import uniform
+from pandas import DataFrame, Series, concat
+from pyproj import Transformer
 from rasterio import open as rasopen
+from rasterio.windows import Window
+from shapely import contains_xy, prepare
 from shapely.geometry import shape, Point, mapping
-from shapely.ops import unary_union
+
+from pixel_classification.training_store import write_training_data, load_training_data
 
 loc = os.path.dirname(__file__)
 WRS_2 = loc.replace('pixel_classification',
@@ -43,6 +51,12 @@ learning algorithm.
 '''
 
 
+POINT_COLUMNS = ['FID', 'X', 'Y', 'POINT_TYPE']
+# candidate points drawn per requested point before _sample_polygon gives up
+# on a polygon, e.g. a sliver covering little of its bounding box.
+MAX_DRAWS_PER_POINT = 100
+
+
 class NoCoordinateReferenceError(Exception):
     pass
 
@@ -59,12 +73,12 @@ class PixelTrainingArray(object):
     """
 
     def __init__(self, root=None, geography=None, paths_map=None, masks=None,
-            instances=None, from_dict=None, pkl_path=None,
+            instances=None, from_dict=None, data_dir=None,
             overwrite_array=False, overwrite_points=False, kernel_size=None):
 
         """
 
-        :param pkl_path:
+        :param data_dir:
         :param overwrite_points:
         :param max_cloud:
         :param training_vectors: in the WGS84 EPSG 4326 coordinate reference system. (str)(.shp)
@@ -75,16 +89,16 @@ class PixelTrainingArray(object):
         be sampled once.  As the sample size becomes large (perhaps 10**5), the dataset will approach
         feature balance. Each point is taken from a random spatial index within each polygon.  Approximate
         feature balance is hard-coded in this class.
-        :param pkl_path: If the data exists, specify this path to instantiate a data-filled instance
-        without repeating the time-consuming sampling process. (bool)
+        :param data_dir: If the data exists, specify this training_store directory to instantiate a
+        data-filled instance without repeating the time-consuming sampling process. (str)
         :param overwrite_array:
         """
 
         self.overwrite_array = overwrite_array
         self.overwrite_points = overwrite_points
 
-        if pkl_path and not overwrite_array:
-            self.from_pickle(pkl_path)
+        if data_dir and not overwrite_array:
+            self.from_store(data_dir)
             self.array_exists = True
 
         elif from_dict:
@@ -108,9 +122,29 @@ class PixelTrainingArray(object):
             self.target_values = None
 
             self.m_instances = instances
-            self.extracted_points = DataFrame(columns=['FID', 'X', 'Y', 'POINT_TYPE'])
+            # sample points are accumulated in numpy columns, and only made
+            # into a DataFrame when extracted_points is read.
+            self._point_x = zeros(0, dtype=float64)
+            self._point_y = zeros(0, dtype=float64)
+            self._point_type = zeros(0, dtype=int64)
+            self._extracted_points = None
             self.object_id = 0
 
+    @property
+    def extracted_points(self):
+        if self._extracted_points is None:
+            n = self.object_id
+            self._extracted_points = DataFrame({'FID': arange(n, dtype=int64),
+                                                'X': self._point_x[:n],
+                                                'Y': self._point_y[:n],
+                                                'POINT_TYPE': self._point_type[:n]},
+                                               columns=POINT_COLUMNS)
+        return self._extracted_points
+
+    @extracted_points.setter
+    def extracted_points(self, df):
+        self._extracted_points = df
+
     def extract_sample(self, save_points=True):
 
         if self.array_exists and not self.overwrite_array:
@@ -139,67 +173,54 @@ class PixelTrainingArray(object):
 
         This complicated-looking function finds the wrs_2 descending Landsat tile corresponding
         to the path row provided, gets the bounding box and profile (aka meta) from
-        compose_array.get_tile_geometry, clips the training data to the landsat tile, then performs a
-        union to reduce the number of polygon objects.
+        compose_array.get_tile_geometry, clips the training data to the landsat tile, and keeps the
+        m_instances largest polygons of each class.
 
         The dict object this uses has a template in pixel_classification.runspec.py.
 
-        Approach is to loop through the polygons, create a random grid of points over the extent of
-        each polygon, random shuffle order of points, loop over points, check if point is within polygon,
-        and if within, create a sample point.
-
-        If a relatively simple geometry is available, use create_negative_sample_points(), though if
-        there ar > 10**4 polygons, it will probably hang on unary_union().
+        Each polygon gets a share of the class's m_instances points proportional to its area (at
+        least one), and its points are found by drawing batches of uniform random points over its
+        bounding box and keeping those it contains (see _sample_polygon). Polygons aren't unioned,
+        so overlapping polygons sample their overlap twice.
 
         """
 
         for class_code, _dict in self.geography.attributes.items():
             print(_dict['ltype'])
             polygons = self._get_polygons(_dict['path']) # this is a hardcoded shapefile name.
+            polygons = [poly for poly in polygons if poly.area > 0]
             _dict['instance_count'] = 0
-
-            if len(polygons) > self.m_instances:
-                areas = zip(polygons, [x.area for x in polygons])
-                srt = sorted(areas, key=lambda x: x[1], reverse=True)
-                polygons = [x for x, y in srt[:self.m_instances]]
-
-            polygons = unary_union(polygons)
-            positive_area = sum([x.area for x in polygons])
-            class_count = 0
-
-            for i, poly in enumerate(polygons):
-                if class_count >= self.m_instances:
-                    break
-                fractional_area = poly.area / positive_area
-                required_points = max([1, fractional_area * self.m_instances])
-                x_range, y_range = self._random_points(poly.bounds)
-                poly_pt_ct = 0
-
-                for coord in zip(x_range, y_range):
-                    if Point(coord[0], coord[1]).within(poly):
-                        self._add_entry(coord, val=class_code)
-                        poly_pt_ct += 1
-                        _dict['instance_count'] += 1
-
-                    if _dict['instance_count'] > self.m_instances:
-                        break
-
-                    if poly_pt_ct >= required_points:
-                        break
-
-                class_count += poly_pt_ct
+            if not polygons:
+                continue
+
+            areas = array([poly.area for poly in polygons])
+            largest = argsort(-areas, kind='stable')[:self.m_instances]
+            counts = self._allocate_points(areas[largest])
+
+            xs, ys = [], []
+            for i, n in zip(largest, counts):
+                x, y = self._sample_polygon(polygons[i], n)
+                xs.append(x)
+                ys.append(y)
+            x, y = concatenate(xs), concatenate(ys)
+            self._add_entries(x, y, val=class_code)
+            _dict['instance_count'] = x.shape[0]
 
     def populate_data_array(self):
 
-        for key, val in self.paths_map.items():
-            s = self._point_raster_extract(val, _name=key)
-            print('Extracting {}'.format(key))
-            self.extracted_points = self.extracted_points.join(s, how='outer')
+        # points are projected once, and rasters are read in parallel threads
+        # (rasterio releases the GIL while reading).
+        x, y = self._projected_points()
+        rasters = list(self.paths_map.items()) + list(self.masks.items())
 
-        for key, val in self.masks.items():
-            s = self._point_raster_extract(val, _name=key)
+        def extract(item):
+            key, val = item
             print('Extracting {}'.format(key))
-            self.extracted_points = self.extracted_points.join(s, how='outer')
+            return self._point_raster_extract(val, _name=key, x=x, y=y)
+
+        with ThreadPool(min(len(rasters), cpu_count())) as pool:
+            series = pool.map(extract, rasters)
+        self.extracted_points = concat([self.extracted_points] + series, axis=1)
 
         data_array, targets = self._purge_array()
         data = {'df': data_array,
@@ -212,34 +233,50 @@ class PixelTrainingArray(object):
         for key, val in data.items():
             setattr(self, key, val)
 
-        self.to_pickle(data)
+        self.to_store(data)
 
         self._check_targets(targets)
 
     def populate_raster_data_array(self):
+        """ Like populate_data_array, but data is an (n_points, n_bands, k, k)
+        float32 array of the kernel_size x kernel_size patches around each point.
+        """
+        x, y = self._projected_points()
 
-        for key, val in self.paths_map.items():
-            s = self._grid_raster_extract(val, _name=key)
+        # points under a mask are dropped before their patches are read.
+        masked = zeros(x.shape[0], dtype=bool)
+        for key, val in self.masks.items():
             print('Extracting {}'.format(key))
-            self.extracted_points = self.extracted_points.join(s, how='outer')
+            center = self._point_raster_extract(val, _name=key, x=x, y=y).values
+            masked |= (center == 1.) | isnan(center)
+        idx = nonzero(~masked)[0]
 
-        for key, val in self.masks.items():
-            s = self._grid_raster_extract(val, _name=key)
+        bands = list(self.paths_map.items())
+        width = 2 * (self.kernel_size // 2) + 1
+        patches = empty((idx.shape[0], len(bands), width, width), dtype=float32)
+
+        def extract(i):
+            key, val = bands[i]
             print('Extracting {}'.format(key))
-            self.extracted_points = self.extracted_points.join(s, how='outer')
+            patches[:, i] = self._grid_raster_extract(val, x[idx], y[idx])
 
-        data_array, targets = self._purge_raster_array()
-        data = {'df': data_array,
-                'features': data_array.columns.values,
-                'data': data_array.values,
+        with ThreadPool(min(len(bands), cpu_count())) as pool:
+            pool.map(extract, range(len(bands)))
+
+        patches, keep = self._purge_raster_array(patches)
+        points = self.extracted_points.iloc[idx[keep]]
+        targets = points.POINT_TYPE.values
+        data = {'df': points,
+                'features': asarray(list(self.paths_map.keys())),
+                'data': patches,
                 'target_values': targets,
                 'paths_map': self.paths_map}
 
-        print('feature dimensions: {}'.format(data_array.shape))
+        print('feature dimensions: {}'.format(patches.shape))
         for key, val in data.items():
             setattr(self, key, val)
 
-        self.to_pickle(data)
+        self.to_store(data)
 
         self._check_targets(targets)
 
@@ -259,58 +296,35 @@ class PixelTrainingArray(object):
                               'geometry': mapping(pt)})
         return None
 
-    def to_pickle(self, data, path=None):
+    def to_store(self, data, path=None):
+        """ Writes data, target_values and features of the data dict to a
+        training_store directory, replacing what's there.
+        """
         if not path:
             path = self.data_path
 
-        with open(path, 'wb') as handle:
-            pickle.dump(data, handle, protocol=2)
+        write_training_data(path, data['data'], data['target_values'], data['features'])
 
         return path
 
-    def from_pickle(self, path=None):
+    def from_store(self, path=None, mmap_mode='r'):
         if not path:
             path = self.data_path
 
-        pkl = pickle.load(open(path, 'rb'))
-        for key, val in pkl.items():
+        for key, val in load_training_data(path, mmap_mode=mmap_mode).items():
             setattr(self, key, val)
 
         self._check_targets(self.target_values)
 
-    def _purge_raster_array(self):
-        data_array = deepcopy(self.extracted_points) # extracted pixels would
-        # be a better name
-        target_vals = Series(data_array.POINT_TYPE.values, name='POINT_TYPE')
-        data_array.drop(['X', 'Y', 'FID', 'POINT_TYPE'], axis=1, inplace=True)
-        try:
-            for msk in self.masks.keys():
-                # TODO: make the below calculation vectorized
-                for idx, sub_raster in enumerate(data_array[msk]):
-                    if sub_raster[self.kernel_size // 2][self.kernel_size // 2] == 1.:
-                        data_array.loc[idx, :] = nan # make whole row NaN
-        except TypeError as e:
-            print(sub_raster, msk, idx)
-            data_array.loc[idx, :] = nan
-
-        try:
-            for bnd in self.paths_map.keys():
-                for idx, sub_raster in enumerate(data_array[bnd]):
-                    if sub_raster[self.kernel_size // 2][self.kernel_size // 2] == 0.:
-                        data_array.loc[idx, :] = nan
-        except TypeError as e:
-            print(sub_raster, msk, idx)
-            data_array.loc[idx, :] = nan
-
-        data_array = data_array.join(target_vals, how='outer')
-
-        data_array.dropna(axis=0, inplace=True)
-        data_array.drop(self.masks, axis=1, inplace=True)
-        target_vals = data_array.POINT_TYPE.values
-
-        data_array = data_array.drop(['POINT_TYPE'],
-                                     axis=1, inplace=False)
-        return data_array, target_vals
+    def _purge_raster_array(self, patches):
+        """ Drops patches whose center pixel is 0 in any band, and patches that
+        aren't entirely on the rasters. Returns the kept patches and the boolean
+        index of the kept points.
+        """
+        ofs = self.kernel_size // 2
+        keep = isfinite(patches).all(axis=(1, 2, 3))
+        keep &= (patches[:, :, ofs, ofs] != 0.).all(axis=1)
+        return patches[keep], keep
 
     def _purge_array(self):
         data_array = deepcopy(self.extracted_points) # extracted pixels would
@@ -357,72 +371,121 @@ class PixelTrainingArray(object):
             warn('This dataset has {} target classes'.format(unique_targets))
             self.is_binary = False
 
-    def _point_raster_extract(self, raster, _name):
+    def _point_raster_extract(self, raster, _name, x=None, y=None):
+        """ Values of the first band of raster at every sample point, nan for
+        points outside of it. Only the window around the points is read.
+        x, y are the projected points, see _projected_points.
+        """
+        if x is None:
+            x, y = self._projected_points()
+
+        values = full(x.shape[0], nan)
         with rasopen(raster, 'r') as rsrc:
-            rass_arr = rsrc.read()
-            rass_arr = rass_arr.reshape(rass_arr.shape[1], rass_arr.shape[2])
-            affine = rsrc.transform
-
-        s = Series(index=range(0, self.extracted_points.shape[0]), name=_name)
-        for ind, row in self.extracted_points.iterrows():
-            x, y = self._geo_point_to_projected_coords(row['X'], row['Y'])
-            c, r = ~affine * (x, y)
-            try:
-                raster_val = rass_arr[int(r), int(c)]
-                s[ind] = float(raster_val)
-            except IndexError:
-                s[ind] = None
-        return s
-
-    def _grid_raster_extract(self, raster, _name):
+            rows, cols, inside = self._pixel_indices(rsrc, x, y)
+            if inside.any():
+                r0, c0 = rows[inside].min(), cols[inside].min()
+                window = Window(c0, r0, cols[inside].max() - c0 + 1, rows[inside].max() - r0 + 1)
+                rass_arr = rsrc.read(1, window=window)
+                values[inside] = rass_arr[rows[inside] - r0, cols[inside] - c0]
+
+        return Series(values, index=range(0, x.shape[0]), name=_name)
+
+    def _projected_points(self):
+        """ X, Y of the sample points (EPSG 4326) in the rasters' crs. """
+        transformer = Transformer.from_crs('EPSG:4326', self.crs, always_xy=True)
+        x, y = transformer.transform(self.extracted_points['X'].values,
+                                     self.extracted_points['Y'].values)
+        return asarray(x), asarray(y)
+
+    @staticmethod
+    def _pixel_indices(src, x, y):
+        """ Row and column of the pixels of src containing x, y, and whether
+        they're inside src.
         """
-        Open the raster. Store the points in a Series - a labeled
-        numpy array. Then in _purge array, we iterate over the masks
-        and the paths_map and drop pixels where masks = 1 and pixels where bound = 0.
+        cols, rows = ~src.transform * (x, y)
+        rows, cols = floor(rows).astype(int64), floor(cols).astype(int64)
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        return rows, cols, inside
+
+    def _grid_raster_extract(self, raster, x, y):
+        """ (n_points, k, k) float32 patches of the first band of raster centered
+        on the projected points x, y, nan where they're off the raster. The window
+        spanning the points is read once, and patches are gathered from a sliding
+        window view of it.
         """
-
+        ofs = self.kernel_size // 2
+        width = 2 * ofs + 1
+        patches = full((x.shape[0], width, width), nan, dtype=float32)
         with rasopen(raster, 'r') as rsrc:
-            rass_arr = rsrc.read()
-            rass_arr = rass_arr.reshape(rass_arr.shape[1], rass_arr.shape[2])
-            affine = rsrc.transform
-
-        s = Series(index=range(0, self.extracted_points.shape[0]), name=_name, dtype=object)
-        for ind, row in self.extracted_points.iterrows():
-            x, y = self._geo_point_to_projected_coords(row['X'], row['Y'])
-            c, r = ~affine * (x, y)
-            try:
-                ofs = self.kernel_size // 2
-                rr = int(r); cc = int(c)
-                raster_subgrid = rass_arr[rr-ofs:rr+ofs+1, cc-ofs:cc+ofs+1] # possible issues: edges of image
-                s[ind] = raster_subgrid
-            except IndexError:
-                s[ind] = None
-
-        return s
-
-    def _random_points(self, coords):
-        min_x, max_x = coords[0], coords[2]
-        min_y, max_y = coords[1], coords[3]
-        x_range = linspace(min_x, max_x, num=2 * self.m_instances)
-        y_range = linspace(min_y, max_y, num=2 * self.m_instances)
-        shuffle(x_range), shuffle(y_range)
-        return x_range, y_range
+            rows, cols, inside = self._pixel_indices(rsrc, x, y)
+            if not inside.any():
+                return patches
+            rows, cols = rows[inside], cols[inside]
+            r0, c0 = rows.min() - ofs, cols.min() - ofs
+            r1, c1 = rows.max() + ofs + 1, cols.max() + ofs + 1
+            window = Window.from_slices((clip(r0, 0, rsrc.height), clip(r1, 0, rsrc.height)),
+                                        (clip(c0, 0, rsrc.width), clip(c1, 0, rsrc.width)))
+            # pixels off the raster stay nan
+            arr = full((r1 - r0, c1 - c0), nan, dtype=float32)
+            arr[window.row_off - r0:window.row_off - r0 + window.height,
+                window.col_off - c0:window.col_off - c0 + window.width] = rsrc.read(1, window=window)
+
+        view = sliding_window_view(arr, (width, width))
+        patches[inside] = view[rows - rows.min(), cols - cols.min()]
+        return patches
+
+    def _allocate_points(self, areas):
+        """ Number of points for each polygon, proportional to areas and at least
+        one, given out in the order of areas until m_instances are allocated.
+        """
+        counts = maximum(1, ceil(areas / areas.sum() * self.m_instances)).astype(int64)
+        remaining = maximum(0, self.m_instances - (cumsum(counts) - counts))
+        return minimum(counts, remaining)
+
+    @staticmethod
+    def _sample_polygon(poly, n):
+        """ x, y of n uniform random points within poly. Candidates are drawn over
+        its bounding box in batches sized by the fraction of the box poly covers.
+        Returns fewer points if they aren't found in MAX_DRAWS_PER_POINT * n draws.
+        """
+        if n == 0:
+            return zeros(0), zeros(0)
+        prepare(poly)
+        min_x, min_y, max_x, max_y = poly.bounds
+        cover = poly.area / ((max_x - min_x) * (max_y - min_y))
+        xs, ys = [], []
+        found, drawn = 0, 0
+        while found < n and drawn < MAX_DRAWS_PER_POINT * n:
+            size = int(ceil(1.2 * (n - found) / cover)) + 16
+            x, y = uniform(min_x, max_x, size), uniform(min_y, max_y, size)
+            inside = contains_xy(poly, x, y)
+            xs.append(x[inside])
+            ys.append(y[inside])
+            found += inside.sum()
+            drawn += size
+        return concatenate(xs)[:n], concatenate(ys)[:n]
 
     def _add_entry(self, coord, val=0):
+        self._add_entries(coord[0], coord[1], val=val)
 
-        self.extracted_points = self.extracted_points.append({'FID': int(self.object_id),
-                                                              'X': coord[0],
-                                                              'Y': coord[1],
-                                                              'POINT_TYPE': val},
-                                                             ignore_index=True)
-        self.object_id += 1
-
-    def _geo_point_to_projected_coords(self, x, y):
-
-        in_crs = Proj(init='epsg:4326')
-        out_crs = Proj(init=self.crs['init'])
-        x, y = transform(in_crs, out_crs, x, y)
-        return x, y
+    def _add_entries(self, x, y, val=0):
+        """ Append points with coordinates x, y (scalars or arrays) and POINT_TYPE val.
+        Columns grow by doubling, so adding n points one at a time is O(n).
+        """
+        x, y = atleast_1d(x), atleast_1d(y)
+        start, stop = self.object_id, self.object_id + x.shape[0]
+        if stop > self._point_x.shape[0]:
+            capacity = max([stop, 2 * self._point_x.shape[0], 1024])
+            for name in ('_point_x', '_point_y', '_point_type'):
+                old = getattr(self, name)
+                new = zeros(capacity, dtype=old.dtype)
+                new[:start] = old[:start]
+                setattr(self, name, new)
+        self._point_x[start:stop] = x
+        self._point_y[start:stop] = y
+        self._point_type[start:stop] = val
+        self.object_id = stop
+        self._extracted_points = None
 
     def _get_crs(self):
         for key, val in self.paths_map.items():
@@ -455,16 +518,13 @@ class PixelTrainingArray(object):
         return polys
 
     def _populate_array_from_points(self):
-        # TODO: replace with geopandas.shp_to_dataframe
-        with fopen(self.shapefile_path, 'r') as src:
-            for feat in src:
-                coords = feat['geometry']['coordinates']
-                val = feat['properties']['POINT_TYPE']
-                self._add_entry(coords, val=val)
+        points = read_file(self.shapefile_path)
+        self._add_entries(points.geometry.x.values, points.geometry.y.values,
+                          val=points['POINT_TYPE'].values)
 
     @property
     def data_path(self):
-        return os.path.join(self.root, 'data.pkl')
+        return os.path.join(self.root, 'data')
 
     @property
     def shapefile_path(self):
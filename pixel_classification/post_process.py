@@ -15,27 +15,145 @@
 # =============================================================================================
 
 import os
+from multiprocessing import Pool
 
+from numpy import bincount, isfinite, issubdtype, floating, ones, zeros, int32, unique
 from rasterio import open as rasopen
-from scipy.ndimage.filters import median_filter
+from rasterio.windows import Window
+from scipy.ndimage import median_filter, correlate1d, label, distance_transform_edt
 
 from sat_image.image import LandsatImage, Landsat8, Landsat7, Landsat5
 
 MAPPING = {'LT5': Landsat5, 'LE7': Landsat7, 'LC8': Landsat8}
 
 
-def filter_image(shapefile, min_filter=6):
-    with rasopen(shapefile, 'r') as src:
-        meta = src.meta.copy()
-        data = src.read()
+def _valid(data, nodata):
+    valid = isfinite(data) if issubdtype(data.dtype, floating) else ones(data.shape, dtype=bool)
+    if nodata is not None:
+        valid &= data != nodata
+    return valid
 
-    filtered = median_filter(data, size=min_filter)
-    out_name = shapefile.replace('binary_raster.tif', 'binary_med_filter_6.tif')
 
-    with rasopen(out_name, 'w', **meta) as dst:
-        dst.write(filtered)
+def _median_block(data, size, nodata, open_edges):
+    return median_filter(data, size=size)
 
-    return None
+
+def _box_sum(data, size):
+    # separable, integer size x size window sums, with the window placed
+    # like median_filter's.
+    out = correlate1d(data.astype(int32), ones(size, dtype=int32), axis=0, mode='reflect')
+    return correlate1d(out, ones(size, dtype=int32), axis=1, mode='reflect')
+
+
+def _mode_block(data, size, nodata, open_edges):
+    """ Most frequent class in the size x size window of each valid pixel, the
+    lowest class winning ties. Invalid pixels don't vote and are left as is.
+    """
+    valid = _valid(data, nodata)
+    out = data.copy()
+    classes = unique(data[valid])
+    if classes.size == 0:
+        return out
+    best = zeros(data.shape, dtype=int32)
+    best_class = zeros(data.shape, dtype=data.dtype)
+    for c in classes:
+        counts = _box_sum((data == c) & valid, size)
+        better = counts > best
+        best[better] = counts[better]
+        best_class[better] = c
+    out[valid] = best_class[valid]
+    return out
+
+
+def _sieve_block(data, size, nodata, open_edges):
+    """ Replaces 4-connected regions of one class smaller than size pixels with
+    the value of the nearest pixel of a kept region. Regions reaching an edge
+    of the block that isn't an edge of the raster are kept, as they may be
+    larger than the part of them in the block.
+    """
+    valid = _valid(data, nodata)
+    edges = [e for e, is_open in zip(((0, slice(None)), (-1, slice(None)),
+                                      (slice(None), 0), (slice(None), -1)), open_edges) if is_open]
+    small = zeros(data.shape, dtype=bool)
+    for c in unique(data[valid]):
+        labels, _ = label((data == c) & valid)
+        keep = bincount(labels.ravel()) >= size
+        keep[0] = True
+        for edge in edges:
+            keep[labels[edge]] = True
+        small |= ~keep[labels]
+
+    sources = valid & ~small
+    if not small.any() or not sources.any():
+        return data
+    _, (rows, cols) = distance_transform_edt(~sources, return_indices=True)
+    out = data.copy()
+    out[small] = data[rows[small], cols[small]]
+    return out
+
+
+FILTERS = {'median': (_median_block, lambda size: size // 2),
+           'mode': (_mode_block, lambda size: size // 2),
+           'sieve': (_sieve_block, lambda size: 2 * size)}
+
+
+def block_windows(height, width, block_size, halo):
+    """ (window, halo_window, open_edges) tiling a height x width raster in
+    block_size blocks, halo_window being the block grown by halo pixels on the
+    sides that aren't raster edges, and open_edges whether its top, bottom,
+    left and right edges are inside the raster.
+    """
+    blocks = []
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            window = Window(col, row, min(block_size, width - col), min(block_size, height - row))
+            r0, c0 = max(row - halo, 0), max(col - halo, 0)
+            r1 = min(row + window.height + halo, height)
+            c1 = min(col + window.width + halo, width)
+            halo_window = Window(c0, r0, c1 - c0, r1 - r0)
+            open_edges = (r0 > 0, r1 < height, c0 > 0, c1 < width)
+            blocks.append((window, halo_window, open_edges))
+    return blocks
+
+
+def _filter_block(args):
+    raster, band, method, size, window, halo_window, open_edges = args
+    with rasopen(raster, 'r') as src:
+        data = src.read(band, window=halo_window)
+        nodata = src.nodata
+    filtered = FILTERS[method][0](data, size, nodata, open_edges)
+    r, c = window.row_off - halo_window.row_off, window.col_off - halo_window.col_off
+    return band, window, filtered[r:r + window.height, c:c + window.width]
+
+
+def filter_image(raster, min_filter=6, method='median', out_name=None, block_size=1024,
+                 n_workers=None):
+    """ Filters each band of raster block by block in a process pool, and writes
+    the blocks as they're done, so rasters of any size are filtered in bounded
+    memory. Blocks are read with a halo wide enough that the result is the same
+    as filtering the whole raster at once.
+
+    :param min_filter: window size in pixels for the 'median' and 'mode'
+    filters, minimum mapping unit in pixels for 'sieve'.
+    :param method: 'median', 'mode' (majority, for classes) or 'sieve'
+    (removes class regions smaller than min_filter pixels).
+    :return: the filtered raster's filename, <raster>_<method>_<min_filter>.tif by default.
+    """
+    if out_name is None:
+        out_name = '{}_{}_{}.tif'.format(os.path.splitext(raster)[0], method, min_filter)
+
+    with rasopen(raster, 'r') as src:
+        meta = src.meta.copy()
+    halo = FILTERS[method][1](min_filter)
+    tasks = [(raster, band, method, min_filter) + block
+             for band in range(1, meta['count'] + 1)
+             for block in block_windows(meta['height'], meta['width'], block_size, halo)]
+
+    with rasopen(out_name, 'w', **meta) as dst, Pool(n_workers) as pool:
+        for band, window, filtered in pool.imap_unordered(_filter_block, tasks):
+            dst.write(filtered, band, window=window)
+
+    return out_name
 
 
 def ndvi(object):
@@ -19,12 +19,14 @@ import sys
 
 abspath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(abspath)
-from numpy import vstack
+from shutil import rmtree
 from datetime import datetime
 
 from pixel_classification.runspec import Montana, Nevada, Oregon, Utah, Washington
 from pixel_classification.prepare_images import ImageStack
 from pixel_classification.compose_array import PixelTrainingArray as Pta
+from pixel_classification.training_store import append_training_data, load_training_data, \
+    read_manifest, training_data_exists
 from pixel_classification.tf_multilayer_perceptron import mlp
 from pixel_classification.classify import classify_multiproc
 from pixel_classification.target_path_rows import get_path_rows
@@ -36,32 +38,32 @@ OBJECT_MAP = {'MT': Montana,
               'UT': Utah,}
               # 'WA': Washington}
 
-def concatenate_training_data(existing, training_array):
+def concatenate_training_data(store, training_array, source=None):
+    """ Appends a PixelTrainingArray's data to the training_store directory store,
+    without reading or rewriting what's already there.
+    """
+    return append_training_data(store, training_array.data, training_array.target_values,
+                                training_array.features, source=source)
 
-    existing_array = existing['data']
-    add_array = training_array.data
-    new_array = vstack((existing_array, add_array))
-    existing_features = existing['features']
-    add_features = training_array.features
-    new_features = vstack((existing_features.reshape((existing_features.shape[0], 1)),
-                           add_features.reshape((add_features.shape[0], 1))))
 
-    existing_labels = existing['target_values']
-    add_labels = training_array.target_values
-    new_lables = vstack((existing_labels.reshape((existing_labels.shape[0], 1)),
-                         add_labels.reshape((add_labels.shape[0], 1))))
+def model_training_scenes(project, n_images, training, model, overwrite=False):
+    """ Adds the states of OBJECT_MAP not yet in the training store to it and trains
+    model on the store. With overwrite, the store is rebuilt from all of them.
+    """
+    store = os.path.join(project, 'data_kernel31')
+    if overwrite and os.path.isdir(store):
+        rmtree(store)
 
-    concatenated = {'data': new_array, 'target_values': new_lables, 'features': new_features}
-
-    return concatenated
-
-
-def model_training_scenes(project, n_images, training, model):
-    training_data = {}
-    first = True
+    done = set()
+    if training_data_exists(store):
+        done = {s['source'] for s in read_manifest(store)['sources']}
 
     for key, val in OBJECT_MAP.items():
 
+        if key in done:
+            print('{} already in {}'.format(key, store))
+            continue
+
         print('Train on {}'.format(key))
 
         project_state_dir = os.path.join(project, key)
@@ -72,9 +74,9 @@ def model_training_scenes(project, n_images, training, model):
         geography = os.path.join(training, key)
         geo = val(geography)
         geo_folder = os.path.join(project, key)
-        geo_data_path = os.path.join(geo_folder, 'data.pkl')
+        geo_data_path = os.path.join(geo_folder, 'data')
 
-        if not os.path.isfile(geo_data_path):
+        if not training_data_exists(geo_data_path):
             geo_data_path = None
 
         i = ImageStack(root=project_state_dir, satellite=geo.sat, path=geo.path, row=geo.row,
@@ -82,24 +84,18 @@ def model_training_scenes(project, n_images, training, model):
         i.build_training()
 
         p = Pta(root=i.root, geography=geo, paths_map=i.paths_map, instances=10000, masks=i.masks,
-                overwrite_array=True, overwrite_points=True, pkl_path=geo_data_path)
+                overwrite_array=True, overwrite_points=True, data_dir=geo_data_path)
 
         p = Pta(root=i.root, geography=geo, paths_map=i.paths_map, instances=5000, masks=i.masks,
-                overwrite_array=False, overwrite_points=False, pkl_path=geo_data_path)
+                overwrite_array=False, overwrite_points=False, data_dir=geo_data_path)
 
         p.extract_sample()
 
-        if first:
-            training_data = {'data': p.data, 'target_values': p.target_values,
-                             'features': p.features}
-            first = False
-        else:
-            training_data = concatenate_training_data(training_data, p)
+        concatenate_training_data(store, p, source=key)
 
         print('Shape {}: {}'.format(key, p.data.shape))
 
-    p = Pta(from_dict=training_data)
-    p.to_pickle(training_data, os.path.join(project, 'data_kernel31.pkl'.format()))
+    p = Pta(from_dict=load_training_data(store))
     mlp(p, model)
     print('Model saved to {} '.format(model))
 
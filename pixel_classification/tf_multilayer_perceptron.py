@@ -19,18 +19,29 @@ import sys
 
 abspath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(abspath)
-from numpy import unique
-from numpy.random import randint
+from numpy import unique, isnan, where, maximum, sqrt, asarray, float32, float64, load, savez
 import tensorflow as tf
 from pandas import get_dummies
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
 
+# rows per chunk when computing and applying feature statistics
+CHUNK_ROWS = 65536
 
-def mlp(data, model_path):
+
+def mlp(data, model_path, steps=10000, batch_size=500, eval_interval=1000, eval_batch_size=65536):
     """
     :param data: Use the PixelTrainingArray class.
     :return:
+
+    Training batches come from a tf.data pipeline that shuffles sample indices,
+    gathers batches and prefetches them; the arrays are fed through placeholders
+    when the iterators are initialized, so they aren't saved in the graph. The
+    test set is evaluated every eval_interval steps with a streaming accuracy
+    metric, eval_batch_size samples at a time.
+
+    Features are standardized with the mean and standard deviation of the
+    training split, which are saved next to the model (see save_statistics)
+    for Classifier to apply to image stacks.
     """
 
     x = data.data
@@ -41,15 +52,32 @@ def mlp(data, model_path):
 
     nodes = 300
     eta = 0.01
-    epochs = 10000
     seed = 128
-    batch_size = 500
 
     x, x_test, y, y_test = train_test_split(x, y, test_size=0.33,
                                             random_state=None)
 
+    _, mean, std = streaming_moments(x[i:i + CHUNK_ROWS] for i in range(0, x.shape[0], CHUNK_ROWS))
+    x = standardize(x, mean, std)
+    x_test = standardize(x_test, mean, std)
+    save_statistics(model_path, mean, std)
+
     X = tf.placeholder("float", [None, n])
     Y = tf.placeholder("float", [None, N])
+    X_test = tf.placeholder("float", [None, n])
+    Y_test = tf.placeholder("float", [None, N])
+
+    train = tf.data.Dataset.range(x.shape[0]).shuffle(x.shape[0], seed=seed).repeat()
+    train = train.batch(batch_size).map(lambda i: (tf.gather(X, i), tf.gather(Y, i)))
+    train = train.prefetch(tf.data.experimental.AUTOTUNE)
+    train_iterator = tf.data.make_initializable_iterator(train)
+    batch_data, batch_labels = train_iterator.get_next()
+
+    test = tf.data.Dataset.range(x_test.shape[0]).batch(eval_batch_size)
+    test = test.map(lambda i: (tf.gather(X_test, i), tf.gather(Y_test, i)))
+    test = test.prefetch(tf.data.experimental.AUTOTUNE)
+    test_iterator = tf.data.make_initializable_iterator(test)
+    test_data, test_labels = test_iterator.get_next()
 
     weights = {
         'hidden': tf.Variable(tf.random_normal([n, nodes], seed=seed), name='Wh'),
@@ -58,41 +86,101 @@ def mlp(data, model_path):
         'hidden': tf.Variable(tf.random_normal([nodes], seed=seed), name='Bh'),
         'output': tf.Variable(tf.random_normal([N], seed=seed), name='Bo')}
 
-    y_pred = tf.add(tf.matmul(multilayer_perceptron(X, weights['hidden'], biases['hidden']),
-                              weights['output']), biases['output'])
+    def logits(inputs):
+        return tf.add(tf.matmul(multilayer_perceptron(inputs, weights['hidden'], biases['hidden']),
+                                weights['output']), biases['output'])
+
+    y_pred = logits(batch_data)
 
-    loss_op = tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(logits=y_pred, labels=Y))
+    loss_op = tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(logits=y_pred, labels=batch_labels))
 
     optimizer = tf.train.AdamOptimizer(learning_rate=eta).minimize(loss_op)
 
+    accuracy, accuracy_update = tf.metrics.accuracy(labels=tf.argmax(test_labels, 1),
+                                                    predictions=tf.argmax(logits(test_data), 1),
+                                                    name='test_accuracy')
+    reset_accuracy = tf.variables_initializer(
+        tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope='test_accuracy'))
+
     init = tf.global_variables_initializer()
     saver = tf.train.Saver()
 
     with tf.Session() as sess:
 
         sess.run(init)
+        sess.run(train_iterator.initializer, feed_dict={X: x, Y: y})
+
+        for step in range(steps):
+
+            _, loss = sess.run([optimizer, loss_op])
 
-        for step in range(epochs):
+            if step % eval_interval == 0:
+                sess.run([test_iterator.initializer, reset_accuracy],
+                         feed_dict={X_test: x_test, Y_test: y_test})
+                while True:
+                    try:
+                        sess.run(accuracy_update)
+                    except tf.errors.OutOfRangeError:
+                        break
+                print('Test accuracy: {}, loss {}'.format(sess.run(accuracy), loss))
 
-            offset = randint(0, y.shape[0] - batch_size - 1)
+        _ = saver.save(sess, model_path)
 
-            batch_data = x[offset:(offset + batch_size), :]
-            batch_labels = y[offset:(offset + batch_size), :]
+    return None
 
-            feed_dict = {X: batch_data, Y: batch_labels}
 
-            _, loss = sess.run([optimizer, loss_op],
-                               feed_dict=feed_dict)
+def streaming_moments(chunks):
+    """ Count, mean and standard deviation of each column of a sequence of 2-D
+    (rows x columns) chunks, ignoring nan, in one pass. Chunks are merged with
+    the pairwise update of Chan et al., so only per-column float64 sums are kept.
+    """
+    n = mean = m2 = None
+    for chunk in chunks:
+        valid = ~isnan(chunk)
+        n_chunk = valid.sum(axis=0)
+        mean_chunk = where(valid, chunk, 0).sum(axis=0, dtype=float64) / maximum(n_chunk, 1)
+        m2_chunk = (where(valid, chunk - mean_chunk, 0) ** 2).sum(axis=0)
+        if n is None:
+            n, mean, m2 = n_chunk, mean_chunk, m2_chunk
+            continue
+        total = n + n_chunk
+        delta = mean_chunk - mean
+        weight = n_chunk / maximum(total, 1)
+        mean = mean + delta * weight
+        m2 = m2 + m2_chunk + delta ** 2 * n * weight
+        n = total
+    return n, mean, sqrt(m2 / maximum(n, 1))
+
+
+def standardize(data, mean, std):
+    """ (data - mean) / std over the columns of data, as float32, in place if
+    data is already a float32 array. Columns with a std of 0 are only centered.
+    """
+    data = asarray(data, dtype=float32)
+    mean = asarray(mean, dtype=float32)
+    std = where(asarray(std) > 0, std, 1).astype(float32)
+    for i in range(0, data.shape[0], CHUNK_ROWS):
+        data[i:i + CHUNK_ROWS] -= mean
+        data[i:i + CHUNK_ROWS] /= std
+    return data
 
-            if step % 1000 == 0:
-                pred = tf.nn.softmax(y_pred)
-                correct_prediction = tf.equal(tf.argmax(pred, 1), tf.argmax(Y, 1))
-                accuracy = tf.reduce_mean(tf.cast(correct_prediction, tf.float32))
-                print('Test accuracy: {}, loss {}'.format(accuracy.eval({X: x_test, Y: y_test}), loss))
 
-        _ = saver.save(sess, model_path)
+def statistics_path(model_path):
+    return '{}.stats.npz'.format(model_path)
 
-    return None
+
+def save_statistics(model_path, mean, std):
+    savez(statistics_path(model_path), mean=mean, std=std)
+
+
+def load_statistics(model_path):
+    """ Feature (mean, std) saved with the model by mlp, None for models
+    saved without them.
+    """
+    if not os.path.isfile(statistics_path(model_path)):
+        return None
+    with load(statistics_path(model_path)) as stats:
+        return stats['mean'], stats['std']
 
 
 def multilayer_perceptron(x, weights, biases):
@@ -0,0 +1,142 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+
+import os
+import json
+from shutil import rmtree
+
+from numpy import asarray, dtype as np_dtype, fromfile, memmap, prod, int64
+
+'''
+Training arrays on disk as a directory of raw, row-major binary columns:
+data.bin holds the samples (n, *sample_shape), targets.bin the target
+value of each sample, and manifest.json their dtypes and shapes, and the
+rows and feature names of each source (e.g. a state) that was appended.
+Features are matched by position: sources built from different scenes
+have different feature names, but the same bands in the same order, i.e.
+the same names once the scene id before the last '_' is dropped.
+
+Samples are appended to the end of the columns, so adding a source doesn't
+rewrite what's there, and the whole store loads as one memmap. The
+manifest is written last, so rows of an interrupted append are ignored
+and overwritten by the next one.
+'''
+
+MANIFEST = 'manifest.json'
+DATA = 'data.bin'
+TARGETS = 'targets.bin'
+
+
+def training_data_exists(directory):
+    return directory is not None and os.path.isfile(os.path.join(directory, MANIFEST))
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return json.load(f)
+
+
+def _write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _band(feature):
+    # 'LC80410272013121LGN01_B4' -> 'B4'; names without a scene id as they are
+    return feature.rsplit('_', 1)[-1]
+
+
+def _append_rows(path, array, n_rows):
+    # drop rows past the manifest's count, left by an interrupted append.
+    row_bytes = int(prod(array.shape[1:], dtype=int64)) * array.dtype.itemsize
+    with open(path, 'ab') as f:
+        f.truncate(n_rows * row_bytes)
+        f.write(array.tobytes(order='C'))
+
+
+def append_training_data(directory, data, target_values, features, source=None):
+    '''
+    Appends the samples in data (n, ...), their target values (n,) and
+    feature names to the store in directory. Later appends must have the
+    same sample shape and bands (see _band) in the same order. data is cast to the dtype of the store. Returns the
+    number of samples in the store.
+    '''
+    data, target_values = asarray(data), asarray(target_values).reshape(-1)
+    features = [str(f) for f in asarray(features).reshape(-1)]
+    if data.shape[0] != target_values.shape[0]:
+        raise ValueError('{} samples and {} target values'.format(data.shape[0],
+                                                                  target_values.shape[0]))
+
+    if training_data_exists(directory):
+        manifest = read_manifest(directory)
+        if list(data.shape[1:]) != manifest['sample_shape']:
+            raise ValueError('samples of shape {} can\'t be added to a store of {}'.format(
+                data.shape[1:], manifest['sample_shape']))
+        if [_band(f) for f in features] != [_band(f) for f in manifest['features']]:
+            raise ValueError('features {} don\'t match the bands of the store, {}'.format(
+                features, manifest['features']))
+    else:
+        os.makedirs(directory, exist_ok=True)
+        manifest = {'features': features,
+                    'sample_shape': list(data.shape[1:]),
+                    'dtype': data.dtype.str,
+                    'target_dtype': target_values.dtype.str,
+                    'n_samples': 0,
+                    'sources': []}
+
+    n = manifest['n_samples']
+    _append_rows(os.path.join(directory, DATA), data.astype(manifest['dtype'], copy=False), n)
+    _append_rows(os.path.join(directory, TARGETS),
+                 target_values.astype(manifest['target_dtype'], copy=False), n)
+
+    manifest['sources'].append({'source': source, 'start': n, 'stop': n + data.shape[0],
+                                'features': features})
+    manifest['n_samples'] = n + data.shape[0]
+    _write_manifest(directory, manifest)
+    return manifest['n_samples']
+
+
+def write_training_data(directory, data, target_values, features, source=None):
+    ''' Replaces the store in directory with these samples. '''
+    if os.path.isdir(directory):
+        rmtree(directory)
+    return append_training_data(directory, data, target_values, features, source)
+
+
+def load_training_data(directory, mmap_mode='r'):
+    '''
+    The store in directory as a dict of data, target_values and features
+    (those of the first source), the keys PixelTrainingArray(from_dict=...)
+    takes. data and target_values are memmaps opened with mmap_mode, or
+    arrays read into memory if mmap_mode is None.
+    '''
+    manifest = read_manifest(directory)
+    n = manifest['n_samples']
+    data_shape = tuple([n] + manifest['sample_shape'])
+
+    def _read(filename, dt, shape):
+        path = os.path.join(directory, filename)
+        # an empty file can't be memory mapped
+        if mmap_mode is None or n == 0:
+            count = int(prod(shape, dtype=int64))
+            return fromfile(path, dtype=dt, count=count).reshape(shape)
+        return memmap(path, dtype=dt, mode=mmap_mode, shape=shape)
+
+    return {'data': _read(DATA, np_dtype(manifest['dtype']), data_shape),
+            'target_values': _read(TARGETS, np_dtype(manifest['target_dtype']), (n,)),
+            'features': asarray(manifest['features'])}
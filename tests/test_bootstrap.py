@@ -0,0 +1,51 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+import unittest
+
+import numpy as np
+
+from gee.utils.bootstrap import regression_stats, bootstrap_regression
+
+
+class TestBootstrapRegression(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.uniform(0, 2e5, 56)
+        self.y = 0.9*self.x + 5000 + rng.normal(0, 1e4, 56)
+
+    def test_regression_stats(self):
+        r2, slope, intercept = regression_stats(self.x, self.y)
+        ref_slope, ref_intercept = np.polyfit(self.x, self.y, 1)
+        ref_r2 = 1 - np.sum((self.x - self.y)**2) / np.sum((self.x - self.x.mean())**2)
+        self.assertAlmostEqual(slope, ref_slope, places=6)
+        self.assertAlmostEqual(intercept, ref_intercept, places=3)
+        self.assertAlmostEqual(r2, ref_r2, places=6)
+
+    def test_bootstrap_chunks(self):
+        samples, intervals = bootstrap_regression(self.x, self.y, n_bags=2500,
+                                                  chunk_size=1000, seed=1)
+        self.assertEqual(samples['slope'].shape, (2500,))
+        self.assertTrue(np.all(samples['slope'] != 0))
+        low, high = intervals['slope']
+        self.assertLess(low, 0.9)
+        self.assertGreater(high, 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,94 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+import numpy as np
+from rasterio import open as rasopen
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+
+from pixel_classification import classify
+from pixel_classification.prepare_images import ImageStack
+from pixel_classification.tf_multilayer_perceptron import save_statistics
+
+
+class _StackPool(object):
+    """ Stands in for the worker pool, keeping the stack the workers would map. """
+    stack = None
+
+    def __init__(self, processes=None, initializer=None, initargs=()):
+        self.initargs = initargs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def starmap(self, func, ranges):
+        model, data_file, out_file, shape = self.initargs
+        _StackPool.stack = np.array(np.memmap(data_file, dtype=np.float32, mode='r', shape=shape))
+
+
+class TestClassifyMultiproc(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.bands = rng.uniform(1000., 5000., (2, 20, 30)).astype(np.float32)
+        profile = {'driver': 'GTiff', 'height': 20, 'width': 30, 'count': 1, 'dtype': 'float32',
+                   'crs': CRS({'init': 'epsg:32612'}),
+                   'transform': Affine(30., 0., 300000., 0., -30., 5000000.)}
+        self.stack = ImageStack(satellite=8)
+        self.stack.paths_map = OrderedDict()
+        for i, band in enumerate(self.bands):
+            path = os.path.join(self.directory, 'B{}.TIF'.format(i + 1))
+            with rasopen(path, 'w', **profile) as dst:
+                dst.write(band, 1)
+            self.stack.paths_map['B{}'.format(i + 1)] = path
+        self.model = os.path.join(self.directory, 'model.ckpt')
+        self.mean, self.std = np.array([2000., 4000.]), np.array([500., 250.])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _classify(self):
+        with mock.patch.object(classify, 'Pool', _StackPool):
+            classify.classify_multiproc(self.model, self.stack,
+                                        result=os.path.join(self.directory, 'result.tif'))
+        return _StackPool.stack
+
+    def test_model_statistics(self):
+        save_statistics(self.model, self.mean, self.std)
+        stack = self._classify()
+        expected = (self.bands - self.mean[:, None, None]) / self.std[:, None, None]
+        np.testing.assert_allclose(stack, expected.reshape(2, -1), rtol=1e-5)
+
+    def test_mismatched_statistics(self):
+        save_statistics(self.model, np.append(self.mean, 0.), np.append(self.std, 1.))
+        with self.assertRaises(ValueError):
+            self._classify()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
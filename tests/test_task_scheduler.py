@@ -0,0 +1,133 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from gee.utils.task_scheduler import TaskScheduler
+
+
+class QueueFull(Exception):
+    pass
+
+
+class FakeExport:
+    '''
+    Stands in for ee.batch.Export. Tasks run for `duration` polls, the
+    first `refusals` starts raise QueueFull and keys in `fail_once` fail on
+    the server the first time they run.
+    '''
+    def __init__(self, duration=2, refusals=0, fail_once=()):
+        self.duration = duration
+        self.refusals = refusals
+        self.fail_once = set(fail_once)
+        self.max_active = 0
+        self.started = []
+        self.tasks = {}
+
+    def task(self, key):
+        export = self
+
+        class Task:
+            id = None
+
+            def start(self):
+                if export.refusals > 0:
+                    export.refusals -= 1
+                    raise QueueFull('Too many tasks already in the queue')
+                self.id = 'task-{}'.format(len(export.started))
+                self.polls = 0
+                self.fails = key in export.fail_once
+                export.fail_once.discard(key)
+                export.started.append(key)
+                export.tasks[self.id] = self
+                active = sum(t.state() in ('READY', 'RUNNING') for t in export.tasks.values())
+                export.max_active = max(export.max_active, active)
+
+            def state(self):
+                if self.polls < export.duration:
+                    return 'RUNNING'
+                return 'FAILED' if self.fails else 'COMPLETED'
+
+            def status(self):
+                self.polls += 1
+                return {'id': self.id, 'state': self.state()}
+
+        return Task()
+
+
+class TestTaskScheduler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.now = [0.0]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _scheduler(self, export, **kwargs):
+        def sleep(s):
+            self.now[0] += s
+        return TaskScheduler(start_exceptions=(QueueFull,), sleep=sleep,
+                             clock=lambda: self.now[0], verbose=False,
+                             get_status=lambda i: export.tasks[i].status(), **kwargs)
+
+    def _add(self, scheduler, export, n):
+        for i in range(n):
+            key = 'patch_{}'.format(i)
+            scheduler.add(key, lambda key=key: export.task(key))
+
+    def test_throttle_and_retry(self):
+        export = FakeExport(refusals=2, fail_once=['patch_3'])
+        scheduler = self._scheduler(export, max_running=4, poll_interval=10,
+                                    base_backoff=10)
+        self._add(scheduler, export, 12)
+        failed = scheduler.run()
+        self.assertEqual(failed, [])
+        self.assertLessEqual(export.max_active, 4)
+        self.assertEqual(sorted(set(export.started)), sorted('patch_{}'.format(i) for i in range(12)))
+        self.assertEqual(export.started.count('patch_3'), 2)
+
+    def test_gives_up_after_retries(self):
+        export = FakeExport(refusals=100)
+        scheduler = self._scheduler(export, max_retries=3, base_backoff=1, max_backoff=4)
+        self._add(scheduler, export, 1)
+        self.assertEqual(scheduler.run(), ['patch_0'])
+
+    def test_resume(self):
+        queue_file = os.path.join(self.tmp, 'queue.json')
+        export = FakeExport(duration=5)
+        scheduler = self._scheduler(export, max_running=2, queue_file=queue_file)
+        self._add(scheduler, export, 4)
+        # interrupt after the first poll, with two tasks submitted.
+        scheduler.sleep = lambda s: (_ for _ in ()).throw(KeyboardInterrupt)
+        with self.assertRaises(KeyboardInterrupt):
+            scheduler.run()
+        with open(queue_file) as f:
+            self.assertEqual(sum(r['state'] == 'SUBMITTED' for r in json.load(f).values()), 2)
+
+        scheduler = self._scheduler(export, max_running=2, queue_file=queue_file)
+        self._add(scheduler, export, 4)
+        self.assertEqual(scheduler.run(), [])
+        self.assertEqual(export.started, ['patch_0', 'patch_1', 'patch_2', 'patch_3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
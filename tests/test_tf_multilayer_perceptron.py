@@ -0,0 +1,54 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+import unittest
+
+import numpy as np
+
+from pixel_classification.tf_multilayer_perceptron import streaming_moments, standardize
+
+
+class TestStandardization(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.data = rng.normal(100., 20., (1000, 4)).astype(np.float32)
+        self.data[rng.rand(*self.data.shape) < 0.1] = np.nan
+        self.data[:, 3] = 7.
+
+    def test_streaming_moments(self):
+        chunks = [self.data[i:i + 64] for i in range(0, self.data.shape[0], 64)]
+        n, mean, std = streaming_moments(chunks)
+        np.testing.assert_array_equal(n, (~np.isnan(self.data)).sum(axis=0))
+        np.testing.assert_allclose(mean, np.nanmean(self.data.astype(np.float64), axis=0),
+                                   rtol=1e-10)
+        np.testing.assert_allclose(std, np.nanstd(self.data.astype(np.float64), axis=0),
+                                   rtol=1e-8, atol=1e-10)
+
+    def test_standardize(self):
+        mean, std = np.nanmean(self.data, axis=0), np.nanstd(self.data, axis=0)
+        scaled = standardize(self.data.copy(), mean, std)
+        self.assertEqual(scaled.dtype, np.float32)
+        np.testing.assert_allclose(np.nanmean(scaled[:, :3], axis=0), 0, atol=1e-5)
+        np.testing.assert_allclose(np.nanstd(scaled[:, :3], axis=0), 1, rtol=1e-5)
+        # a constant column is only centered
+        np.testing.assert_array_equal(scaled[:, 3], 0)
+        np.testing.assert_array_equal(np.isnan(scaled), np.isnan(self.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================
@@ -0,0 +1,84 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from pixel_classification.training_store import append_training_data, load_training_data, \
+    write_training_data, read_manifest, DATA
+
+
+class TestTrainingStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(tempfile.mkdtemp(), 'data')
+        rng = np.random.RandomState(0)
+        self.features = np.array(['b1', 'b2', 'b3'])
+        self.parts = [(rng.rand(n, 3, 5, 5).astype(np.float32), rng.randint(0, 3, n))
+                      for n in (10, 7, 4)]
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def test_append_and_mmap(self):
+        for i, (data, targets) in enumerate(self.parts):
+            append_training_data(self.directory, data, targets, self.features, source=str(i))
+        loaded = load_training_data(self.directory)
+        self.assertIsInstance(loaded['data'], np.memmap)
+        np.testing.assert_array_equal(loaded['data'], np.concatenate([d for d, _ in self.parts]))
+        np.testing.assert_array_equal(loaded['target_values'],
+                                      np.concatenate([t for _, t in self.parts]))
+        np.testing.assert_array_equal(loaded['features'], self.features)
+        sources = read_manifest(self.directory)['sources']
+        self.assertEqual([(s['start'], s['stop']) for s in sources], [(0, 10), (10, 17), (17, 21)])
+
+    def test_interrupted_append_is_overwritten(self):
+        data, targets = self.parts[0]
+        write_training_data(self.directory, data, targets, self.features)
+        # rows written without a manifest update, as if an append was killed
+        with open(os.path.join(self.directory, DATA), 'ab') as f:
+            f.write(self.parts[1][0].tobytes())
+        append_training_data(self.directory, *self.parts[2], features=self.features)
+        loaded = load_training_data(self.directory, mmap_mode=None)
+        np.testing.assert_array_equal(loaded['data'], np.concatenate([data, self.parts[2][0]]))
+
+    def test_mismatched_shape(self):
+        data, targets = self.parts[0]
+        write_training_data(self.directory, data, targets, self.features)
+        with self.assertRaises(ValueError):
+            append_training_data(self.directory, data[:, :2], targets, self.features[:2])
+
+    def test_mismatched_bands(self):
+        data, targets = self.parts[0]
+        features = np.array(['LC80410272013121LGN01_{}'.format(b) for b in ('B1', 'B2', 'B3')])
+        write_training_data(self.directory, data, targets, features)
+        # another scene, same bands: appended by position
+        other = np.array(['LC80390292013107LGN01_{}'.format(b) for b in ('B1', 'B2', 'B3')])
+        append_training_data(self.directory, *self.parts[1], features=other)
+        with self.assertRaises(ValueError):
+            append_training_data(self.directory, *self.parts[1], features=other[[0, 2, 1]])
+        with self.assertRaises(ValueError):
+            append_training_data(self.directory, data[:, :2], targets, other[:2])
+        self.assertEqual(read_manifest(self.directory)['n_samples'], 17)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ===============================================================================